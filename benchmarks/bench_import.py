@@ -0,0 +1,56 @@
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+'''
+Import time of the server extension, as paid by every Jupyter server at startup, and of the analysis
+engine it loads on the first /detect request; each measurement runs in a fresh interpreter
+'''
+MODULES = ["data_leakage_detection", "data_leakage_detection.main"]
+HEAVY = ["pandas", "pygments", "astunparse", "IPython", "nbformat", "data_leakage_detection.main"]
+
+PROBE = '''
+import sys, time, json
+st = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - st, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def measure(module):
+    out = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1])
+    return json.loads(out.stdout)
+
+def slowest_imports(module, top):
+    """Cumulative microseconds of the slowest imports, from python -X importtime."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the import time of the extension and the analysis engine')
+    parser.add_argument('modules', nargs="*", default=MODULES)
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='fresh interpreters per module, the median is kept')
+    parser.add_argument('--top', type=int, default=0, help='also list the N slowest imports')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        try:
+            runs = [measure(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print("{:<32} failed: {}".format(module, e))
+            continue
+        median = statistics.median(run["seconds"] for run in runs)
+        print("{:<32} {:>8.1f} ms  loads: {}".format(module, median * 1000, ", ".join(runs[0]["loaded"]) or "-"))
+        for cumulative, name in slowest_imports(module, args.top):
+            print("    {:>8.1f} ms  {}".format(cumulative / 1000, name))
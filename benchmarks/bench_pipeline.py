@@ -0,0 +1,138 @@
+import os, sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from corpus import generate_cells, write_case
+
+'''
+End-to-end benchmark of main.main over synthetic notebooks of increasing size
+
+Every case runs in its own process with all caches and the warm pyright server off, so that its
+peak memory and stage times are its own. Results are written as JSON; --baseline compares them with an earlier run.
+'''
+SIZES = [10, 50, 200, 1000, 5000]
+# train/test splits per block, preprocessing chain length, models per split
+VARIANTS = [(1, 1, 1), (2, 3, 2), (4, 2, 4)]
+STAGES = ["parse", "ir", "inference", "reparse", "facts", "datalog", "render"]
+
+def histogram_sums(registry, name):
+    return {dict(key).get('stage', ''): h.sum for key, h in registry.histograms.get(name, {}).items()}
+
+def run_case(script_path, render, results):
+    from data_leakage_detection.config import configs
+    configs.result_cache = False
+    configs.artifact_store = False
+    configs.output_flag = render
+    # one analysis per process: a warm pyright server would only add its startup to the inference stage
+    configs.inference_server = False
+    configs.souffle_background_compile = False  # compiled ahead by the parent, see __main__
+    from data_leakage_detection.main import main
+    from data_leakage_detection.metrics import metrics
+
+    st = time.time()
+    ret = main(script_path)
+    elapsed = time.time() - st
+    stage_seconds = histogram_sums(metrics, "stage_seconds")
+    results.put({
+        'status': ret if isinstance(ret, str) else "ok",
+        'total_seconds': elapsed,
+        'stage_seconds': {stage: stage_seconds.get(stage, 0) for stage in STAGES},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # pyright and souffle
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'fact_bytes': histogram_sums(metrics, "fact_bytes").get('', 0),
+        'fact_tuples': histogram_sums(metrics, "fact_tuples").get('', 0),
+        'output_tuples': histogram_sums(metrics, "output_tuples").get('', 0),
+        'report_entries': len(ret) if isinstance(ret, list) else None,
+    })
+
+def bench(case, script_path, render, timeout):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_case, args=(script_path, render, results))
+    proc.start()
+    proc.join(timeout)
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+        return dict(case, status="timeout")
+    if results.empty():
+        return dict(case, status="crashed")
+    return dict(case, **results.get())
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip()
+    except OSError:
+        return ""
+
+def compare(results, baseline_path, tolerance, min_seconds):
+    """Print the cases and stages slower than the baseline by more than tolerance, return their number."""
+    with open(baseline_path) as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    regressions = 0
+    for r in results:
+        old = baseline.get(r['name'])
+        if old is None or r['status'] != "ok" or old['status'] != "ok":
+            continue
+        pairs = [("total", old['total_seconds'], r['total_seconds'])]
+        pairs += [(stage, old['stage_seconds'][stage], r['stage_seconds'][stage]) for stage in STAGES]
+        for what, before, after in pairs:
+            if after - before > max(min_seconds, before * tolerance):
+                print("REGRESSION {} {}: {:.2f}s -> {:.2f}s".format(r['name'], what, before, after))
+                regressions += 1
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline on synthetic notebooks')
+    parser.add_argument('-o', '--output', help='where to write the JSON results', default="bench_results.json")
+    parser.add_argument('--sizes', help='numbers of cells', type=int, nargs="+", default=SIZES)
+    parser.add_argument('--variants', help='splits,preprocessing,models triples, e.g. 1,1,1 2,3,2',
+                        nargs="+", default=[",".join(map(str, v)) for v in VARIANTS])
+    parser.add_argument('--no-render', help='skip the html report', action="store_true")
+    parser.add_argument('--timeout', help='seconds per case', type=float, default=1800)
+    parser.add_argument('--baseline', help='earlier results to check for regressions')
+    parser.add_argument('--tolerance', help='allowed slowdown as a fraction of the baseline', type=float, default=0.2)
+    parser.add_argument('--min-seconds', help='ignore slowdowns below this many seconds', type=float, default=0.05)
+    args = parser.parse_args()
+
+    # every case runs in a short-lived process, which would otherwise start a compilation of its own and time the interpreter
+    from data_leakage_detection.datalog import compile_ahead
+    compile_ahead()
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    results = []
+    try:
+        for size in args.sizes:
+            for variant in args.variants:
+                splits, preprocessing, models = map(int, variant.split(","))
+                name = f"cells{size}-splits{splits}-pre{preprocessing}-models{models}"
+                cells = generate_cells(size, splits, preprocessing, models)
+                script_path = write_case(os.path.join(scratch, name), name, cells)
+                with open(script_path) as f:
+                    lines = sum(1 for _ in f)
+                case = {'name': name, 'cells': size, 'lines': lines, 'splits': splits,
+                        'preprocessing': preprocessing, 'models': models}
+                r = bench(case, script_path, not args.no_render, args.timeout)
+                results.append(r)
+                print("{:<40} {:>8} {:>8.2f}s  {}".format(name, r['status'], r.get('total_seconds', 0),
+                      "  ".join("{} {:.2f}".format(stage, r['stage_seconds'][stage]) for stage in STAGES) if r['status'] == "ok" else ""))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            'meta': {'commit': git_commit(), 'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+                     'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'results': results,
+        }, f, indent=2)
+    print("Results written to " + args.output)
+    if args.baseline and compare(results, args.baseline, args.tolerance, args.min_seconds):
+        sys.exit(1)
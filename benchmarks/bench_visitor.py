@@ -0,0 +1,79 @@
+import os
+import ast
+import json
+import time
+import argparse
+import tempfile
+
+from corpus import generate_cells, to_script
+
+'''
+Micro-benchmark of the front-end visitors: nodes per second of GlobalCollector, CodeTransformer and
+FactGenerator with the cached dispatch tables, and with the per-node getattr dispatch they used before
+'''
+class StringDispatch(object):
+    def visit(self, node):
+        method = 'visit_' + node.__class__.__name__
+        visitor = getattr(self, method, self.generic_visit)
+        return visitor(node)
+
+def uncached(cls):
+    return type("Uncached" + cls.__name__, (StringDispatch, cls), {})
+
+def count_nodes(tree):
+    return sum(1 for _ in ast.walk(tree))
+
+def best_time(run, repeat):
+    times = []
+    for _ in range(repeat):
+        st = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - st)
+    return min(times)
+
+def bench(code, repeat):
+    from data_leakage_detection.global_collector import GlobalCollector
+    from data_leakage_detection.irgen import CodeTransformer, unparse
+    from data_leakage_detection.factgen import FactGenerator
+
+    tree = ast.parse(code)
+    nodes = count_nodes(tree)
+    ignored_vars = GlobalCollector().visit(tree)
+    ir_code, _ = unparse(CodeTransformer(ignored_vars).visit(ast.parse(code)))
+    ir_nodes = count_nodes(ast.parse(ir_code))
+    # every name typed, as pyright would for a notebook of dataframes
+    types = {node.id: ["var", "pandas.DataFrame"] for node in ast.walk(ast.parse(ir_code)) if isinstance(node, ast.Name)}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(types, f)
+        json_path = f.name
+
+    # the transformers rewrite their input, they get a fresh tree every time
+    def lower(cls):
+        trees = [ast.parse(code) for _ in range(repeat)]
+        return lambda: cls(ignored_vars).visit(trees.pop())
+    def facts(cls):
+        trees = [ast.parse(ir_code) for _ in range(repeat)]
+        return lambda: cls(json_path).visit(trees.pop())
+
+    results = []
+    try:
+        for name, cls, make_run, n in [("GlobalCollector", GlobalCollector, lambda cls: lambda: cls().visit(tree), nodes),
+                                       ("CodeTransformer", CodeTransformer, lower, nodes),
+                                       ("FactGenerator", FactGenerator, facts, ir_nodes)]:
+            before = best_time(make_run(uncached(cls)), repeat)
+            after = best_time(make_run(cls), repeat)
+            results.append((name, n, n / before, n / after))
+    finally:
+        os.remove(json_path)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the dispatch of the front-end visitors')
+    parser.add_argument('-n', '--cells', type=int, default=1000, help='cells of the synthetic notebook')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per visitor, the fastest one is kept')
+    args = parser.parse_args()
+
+    code = to_script(generate_cells(args.cells, 2, 3, 2))
+    print("{:<16} {:>8} {:>14} {:>14} {:>8}".format("visitor", "nodes", "getattr n/s", "cached n/s", "gain"))
+    for name, n, before, after in bench(code, args.repeat):
+        print("{:<16} {:>8} {:>14,.0f} {:>14,.0f} {:>7.1f}%".format(name, n, before, after, (after / before - 1) * 100))
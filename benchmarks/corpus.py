@@ -0,0 +1,97 @@
+import os
+import json
+import random
+import argparse
+
+'''
+Synthetic ML notebooks for benchmarking: repeated load / preprocess / split / fit / evaluate blocks,
+with a share of them preprocessing before the split so that the leakage rules have something to report
+'''
+PREPROCESSORS = [
+    ("sklearn.preprocessing", "StandardScaler", "StandardScaler()"),
+    ("sklearn.preprocessing", "MinMaxScaler", "MinMaxScaler()"),
+    ("sklearn.impute", "SimpleImputer", "SimpleImputer(strategy='mean')"),
+    ("sklearn.decomposition", "PCA", "PCA(n_components=5)"),
+    ("sklearn.feature_selection", "SelectKBest", "SelectKBest(k=5)"),
+]
+MODELS = [
+    ("sklearn.linear_model", "LogisticRegression", "LogisticRegression(max_iter=200)"),
+    ("sklearn.ensemble", "RandomForestClassifier", "RandomForestClassifier(n_estimators=50)"),
+    ("sklearn.svm", "SVC", "SVC()"),
+    ("sklearn.neighbors", "KNeighborsClassifier", "KNeighborsClassifier()"),
+]
+
+def imports():
+    lines = ["import numpy as np", "import pandas as pd", "from sklearn.model_selection import train_test_split"]
+    for module, name, _ in PREPROCESSORS + MODELS:
+        lines.append(f"from {module} import {name}")
+    return "\n".join(lines)
+
+def block_cells(i, rng, splits, preprocessing, models, leak_ratio):
+    """Cells of one load-to-evaluate block, names are suffixed by the block number."""
+    cells = [f"df{i} = pd.read_csv('data{i}.csv')\nX{i} = df{i}.drop('target', axis=1)\ny{i} = df{i}['target']"]
+    leaky = rng.random() < leak_ratio
+    chain = [rng.choice(PREPROCESSORS) for _ in range(preprocessing)]
+    if leaky:  # fit the preprocessing on everything, then split
+        for j, (_, _, ctor) in enumerate(chain):
+            cells.append(f"pre{i}_{j} = {ctor}\nX{i} = pre{i}_{j}.fit_transform(X{i}, y{i})")
+    for s in range(splits):
+        cells.append(f"X_train{i}_{s}, X_test{i}_{s}, y_train{i}_{s}, y_test{i}_{s} = "
+                     f"train_test_split(X{i}, y{i}, test_size=0.2, random_state={s})")
+        if not leaky:
+            for j, (_, _, ctor) in enumerate(chain):
+                cells.append(f"pre{i}_{s}_{j} = {ctor}\n"
+                             f"X_train{i}_{s} = pre{i}_{s}_{j}.fit_transform(X_train{i}_{s}, y_train{i}_{s})\n"
+                             f"X_test{i}_{s} = pre{i}_{s}_{j}.transform(X_test{i}_{s})")
+        for m in range(models):
+            _, _, ctor = rng.choice(MODELS)
+            cells.append(f"model{i}_{s}_{m} = {ctor}\nmodel{i}_{s}_{m}.fit(X_train{i}_{s}, y_train{i}_{s})")
+            cells.append(f"print(model{i}_{s}_{m}.score(X_test{i}_{s}, y_test{i}_{s}))")
+    return cells
+
+def generate_cells(num_cells, splits=1, preprocessing=2, models=2, leak_ratio=0.3, seed=0):
+    rng = random.Random(seed)
+    cells = [imports()]
+    i = 0
+    while len(cells) < num_cells:
+        cells.extend(block_cells(i, rng, splits, preprocessing, models, leak_ratio))
+        i += 1
+    return cells[:num_cells]
+
+def to_script(cells):
+    # the layout of `jupyter nbconvert --to script`
+    out = ["#!/usr/bin/env python", "# coding: utf-8", ""]
+    for n, cell in enumerate(cells, 1):
+        out += ["# In[{}]:".format(n), "", "", cell, "", ""]
+    return "\n".join(out) + "\n"
+
+def to_notebook(cells):
+    return {
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [],
+                   "source": cell.splitlines(True)} for cell in cells],
+        "metadata": {"language_info": {"name": "python"}},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+
+def write_case(folder, name, cells):
+    """Write <name>.py and <name>.ipynb, return the script path."""
+    os.makedirs(folder, exist_ok=True)
+    script_path = os.path.join(folder, name + ".py")
+    with open(script_path, "w") as f:
+        f.write(to_script(cells))
+    with open(os.path.join(folder, name + ".ipynb"), "w") as f:
+        json.dump(to_notebook(cells), f, indent=1)
+    return script_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic notebook')
+    parser.add_argument('dir', help='output directory')
+    parser.add_argument('-n', '--cells', type=int, default=100)
+    parser.add_argument('--splits', type=int, default=1, help='train/test splits per block')
+    parser.add_argument('--preprocessing', type=int, default=2, help='length of the preprocessing chains')
+    parser.add_argument('--models', type=int, default=2, help='models fitted per split')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    cells = generate_cells(args.cells, args.splits, args.preprocessing, args.models, seed=args.seed)
+    print(write_case(args.dir, f"synthetic_{args.cells}", cells))
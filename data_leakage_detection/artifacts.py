@@ -0,0 +1,131 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from .config import configs
+from .cache import hash_files
+from . import datalog
+from .metrics import cache_lookup
+
+'''
+Content-addressed store of intermediate pipeline outputs (IR, type map, facts, souffle outputs)
+
+An artifact is keyed by the hash of its stage inputs and of the code of that stage,
+so changing main.dl only reruns souffle, changing factgen reruns facts and souffle, and so on.
+'''
+# the modules lowering goes through, irgen takes its fresh names from factgen
+_ir_version = hash_files(["notebook.py", "global_collector.py", "scope.py", "visitor.py", "irgen.py", "factgen.py", "incremental.py"])
+_facts_version = hash_files(["scope.py", "visitor.py", "factgen.py"])
+_types_version = None
+
+def types_version():
+    # the pyright bundle is large, identify it by its metadata
+    global _types_version
+    if _types_version is None:
+        bundle = os.path.join(os.path.dirname(configs.inference_path), "dist", "pyright.js")
+        try:
+            st = os.stat(bundle)
+            _types_version = f"{st.st_size}-{st.st_mtime_ns}"
+        except OSError:
+            _types_version = ""
+    return _types_version
+
+def stage_version(stage):
+    if stage == "ir":
+        return _ir_version
+    elif stage == "types":
+        return types_version()
+    elif stage == "facts":
+        return _facts_version
+    elif stage == "datalog":
+        return datalog.program_key()
+    assert False, "Unknown stage! " + stage
+
+def hash_file(h, path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+def list_files(folder, suffix, excluded=()):
+    return sorted(name for name in os.listdir(folder) if name.endswith(suffix) and name not in excluded)
+
+
+class ArtifactStore(object):
+    def __init__(self, root, max_bytes) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stores_since_eviction = 0
+        self.lock = threading.Lock()
+
+    def key(self, stage, inputs):
+        """Hash the stage code version and its inputs, a list of (label, file path)."""
+        h = hashlib.sha256(stage.encode())
+        h.update(stage_version(stage).encode())
+        for label, path in inputs:
+            h.update(f"\0{label}\0{os.path.getsize(path)}\0".encode())
+            hash_file(h, path)
+        return h.hexdigest()
+
+    def entry_path(self, stage, key):
+        return os.path.join(self.root, stage, key[:2], key)
+
+    def fetch(self, stage, key, dest_dir, renames={}):
+        """Copy the artifact files into dest_dir, return the fetched names or None on a miss."""
+        entry = self.entry_path(stage, key)
+        try:
+            names = os.listdir(entry)
+            for name in names:
+                shutil.copyfile(os.path.join(entry, name), os.path.join(dest_dir, renames.get(name, name)))
+            os.utime(entry)  # recently used
+        except OSError:
+            cache_lookup("artifact", False, stage)
+            return None
+        cache_lookup("artifact", True, stage)
+        return names
+
+    def store(self, stage, key, src_dir, names, renames={}):
+        """Save src_dir/<name> for all names as one artifact, stored as renames.get(name, name)."""
+        entry = self.entry_path(stage, key)
+        if os.path.exists(entry):
+            return
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry), suffix=".tmp")
+            for name in names:
+                shutil.copyfile(os.path.join(src_dir, name), os.path.join(tmp_entry, renames.get(name, name)))
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:  # stored concurrently by another analysis
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+        except OSError as e:
+            print("Failed to store artifact: " + str(e))
+            return
+        with self.lock:
+            self.stores_since_eviction += 1
+            if self.stores_since_eviction < 50:
+                return
+            self.stores_since_eviction = 0
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for stage in os.listdir(self.root):
+            for prefix in os.listdir(os.path.join(self.root, stage)):
+                prefix_dir = os.path.join(self.root, stage, prefix)
+                for key in os.listdir(prefix_dir):
+                    entry = os.path.join(prefix_dir, key)
+                    try:
+                        size = sum(f.stat().st_size for f in os.scandir(entry))
+                        entries.append((os.stat(entry).st_mtime, size, entry))
+                    except OSError:
+                        continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):  # least recently used first
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+artifact_store = ArtifactStore(configs.artifact_dir, configs.artifact_store_bytes)
@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from .config import configs
+from . import datalog
+from .metrics import cache_lookup
+
+'''
+Memoization of final reports, keyed by the analyzed source and the analyzer version
+'''
+HERE = os.path.dirname(__file__)
+# every module of the package: notebook conversion, incremental lowering and the handlers shape results too
+ANALYZER_SOURCES = sorted(name for name in os.listdir(HERE) if name.endswith(".py"))
+
+def hash_files(names):
+    h = hashlib.sha256()
+    for name in names:
+        with open(os.path.join(HERE, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# python modules are loaded once, main.dl is re-read by every souffle run
+_sources_hash = hash_files(ANALYZER_SOURCES)
+
+def analyzer_fingerprint():
+    return _sources_hash + datalog.program_key()
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_memory_bytes, max_disk_bytes) -> None:
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        # entries are kept serialized, so callers always get their own copy
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(source, *extra):
+        h = hashlib.sha256(source)
+        h.update(analyzer_fingerprint().encode())
+        for x in extra:
+            h.update(str(x).encode())
+        return h.hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                cache_lookup("result", True)
+                return json.loads(self.memory[key])
+        path = self.disk_path(key)
+        try:
+            with open(path) as f:
+                value = f.read()
+            os.utime(path)  # keep recently used entries on disk
+        except OSError:
+            cache_lookup("result", False)
+            return None
+        cache_lookup("result", True)
+        self.put_memory(key, value)
+        return json.loads(value)
+
+    def put(self, key, result):
+        value = json.dumps(result)
+        self.put_memory(key, value)
+        self.put_disk(key, value)
+
+    def put_memory(self, key, value):
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key))
+            self.memory[key] = value
+            self.memory_bytes += len(value)
+            while self.memory_bytes > self.max_memory_bytes and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def put_disk(self, key, value):
+        path = self.disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+            self.evict_disk()
+        except OSError as e:
+            print("Failed to cache result: " + str(e))
+
+    def evict_disk(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):  # least recently used first
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+result_cache = ResultCache(configs.result_cache_dir, configs.result_cache_memory_bytes, configs.result_cache_disk_bytes)
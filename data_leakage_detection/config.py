@@ -1,7 +1,59 @@
 import os
+from typing import Union
+
+CACHE_ROOT = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "data_leakage_detection")
 
 class Config(object):
-    def __init__(self, inference_path: str, output_flag: bool) -> None:
+    def __init__(self, inference_path: str, output_flag: bool, max_workers: int = 2, max_finished_jobs: int = 100,
+                 inference_server: bool = True, inference_timeout: int = 300,
+                 souffle_compile: bool = True, souffle_cache_dir: str = os.path.join(CACHE_ROOT, "souffle"),
+                 souffle_jobs: Union[int, str] = "auto",
+                 result_cache: bool = True, result_cache_dir: str = os.path.join(CACHE_ROOT, "results"),
+                 result_cache_memory_bytes: int = 64 << 20, result_cache_disk_bytes: int = 512 << 20,
+                 artifact_store: bool = True, artifact_dir: str = os.path.join(CACHE_ROOT, "artifacts"),
+                 artifact_store_bytes: int = 4 << 30, incremental: bool = True, incremental_notebooks: int = 16,
+                 output_profile: str = "production", fact_streaming: bool = False, fact_buffer_bytes: int = 1 << 20,
+                 prewarm_delay: Union[float, None] = None, scratch_dir: Union[str, None] = None,
+                 scheduler_dir: Union[str, None] = None, scheduler_slots: int = max(1, (os.cpu_count() or 2) // 2),
+                 scheduler_max_queue: int = 32, scheduler_stage_seconds: int = 30, datalog_timeout: int = 300,
+                 inference_cpu_seconds: Union[int, None] = 300, inference_memory_bytes: Union[int, None] = 4 << 30,
+                 datalog_cpu_seconds: Union[int, None] = 600, datalog_memory_bytes: Union[int, None] = 4 << 30,
+                 adaptive_precision: bool = True, souffle_background_compile: bool = True,
+                 inference_server_max_requests: int = 100, inference_server_max_rss_bytes: Union[int, None] = 2 << 30) -> None:
         self.inference_path = inference_path
         self.output_flag = output_flag
-configs = Config(os.path.join(os.path.dirname(__file__), "pyright/packages/pyright/index.js"), True)
\ No newline at end of file
+        self.max_workers = max_workers  # concurrent analyses run by the server extension
+        self.max_finished_jobs = max_finished_jobs  # finished jobs kept around for polling
+        self.inference_server = inference_server  # keep warm pyright processes, see inference.py
+        self.inference_timeout = inference_timeout  # seconds, for a warm server or a one-shot pyright
+        self.souffle_compile = souffle_compile  # evaluate main.dl with a compiled binary once built
+        self.souffle_cache_dir = souffle_cache_dir  # compiled binaries, keyed by main.dl and souffle version
+        self.souffle_jobs = souffle_jobs  # souffle threads, or "auto" to size them from the facts
+        self.result_cache = result_cache  # memoize reports of unchanged sources, see cache.py
+        self.result_cache_dir = result_cache_dir
+        self.result_cache_memory_bytes = result_cache_memory_bytes
+        self.result_cache_disk_bytes = result_cache_disk_bytes
+        self.artifact_store = artifact_store  # reuse per-stage outputs, see artifacts.py
+        self.artifact_dir = artifact_dir
+        self.artifact_store_bytes = artifact_store_bytes
+        self.incremental = incremental  # lower notebook cells incrementally, see incremental.py
+        self.incremental_notebooks = incremental_notebooks  # notebooks whose cells are kept
+        self.output_profile = output_profile  # relations souffle writes, "production" or "debug", see datalog.py
+        self.fact_streaming = fact_streaming  # write facts while they are generated, for very large scripts
+        self.fact_buffer_bytes = fact_buffer_bytes  # facts buffered in memory when streaming
+        self.prewarm_delay = prewarm_delay  # seconds after startup to load the analysis in the background, None for the first request
+        self.scratch_dir = scratch_dir  # root of the per-job workspaces, None for /dev/shm or the temp dir, see workspace.py
+        self.scheduler_dir = scheduler_dir  # shared by all the servers of the node, None for the temp dir, see scheduler.py
+        self.scheduler_slots = scheduler_slots  # pyright and souffle runs at once on the node, 0 for no limit
+        self.scheduler_max_queue = scheduler_max_queue  # waiting stages beyond which new requests get a 503
+        self.scheduler_stage_seconds = scheduler_stage_seconds  # typical heavy stage, for Retry-After
+        self.datalog_timeout = datalog_timeout  # seconds, souffle is killed past it
+        self.inference_cpu_seconds = inference_cpu_seconds  # rlimits of pyright, per request of a warm server, None for no limit
+        self.inference_memory_bytes = inference_memory_bytes
+        self.datalog_cpu_seconds = datalog_cpu_seconds  # rlimits of souffle, its threads share the CPU budget
+        self.datalog_memory_bytes = datalog_memory_bytes
+        self.adaptive_precision = adaptive_precision  # rerun stages over budget at a lower precision, see main.py
+        self.souffle_background_compile = souffle_background_compile  # build a missing binary in a background thread, else interpret
+        self.inference_server_max_requests = inference_server_max_requests  # requests a warm pyright serves before a restart, 0 for no limit
+        self.inference_server_max_rss_bytes = inference_server_max_rss_bytes  # resident memory past which it restarts, None for no limit
+configs = Config(os.path.join(os.path.dirname(__file__), "pyright/packages/pyright/index.js"), True)
@@ -0,0 +1,178 @@
+import os, sys
+import re
+import atexit
+import shutil
+import signal
+import hashlib
+import tempfile
+import threading
+import subprocess
+from .config import configs
+from .scheduler import scheduler
+
+'''
+Soufflé invocation: a native evaluator compiled from main.dl is used whenever it has been built,
+the interpreter is only the fallback while the (background) compilation is pending or failed.
+Batch runs compile ahead in the parent, see compile_ahead, as their worker processes may die any time
+'''
+DL_PATH = os.path.join(os.path.dirname(__file__), "main.dl")
+AUTO_JOBS_FACT_BYTES = 256 * 1024  # facts per extra thread in auto mode
+# preprocessor macros of each output profile, see the outputs at the end of main.dl
+OUTPUT_PROFILES = {
+    "production": [],  # only the relations render.py reads
+    "debug": ["DEBUG_OUTPUT"],  # every intermediate relation as well
+}
+# macros of each precision level, from the most precise; the next one is tried when souffle exceeds its budget
+PRECISION_LEVELS = {
+    "2-call-site": [],
+    "1-call-site": ["REDUCED_CONTEXT"],
+    "context-insensitive": ["NO_CONTEXT"],
+}
+FULL_PRECISION = next(iter(PRECISION_LEVELS))
+
+_version = None
+_inputs = None
+_compile_lock = threading.Lock()
+_compiling = set()
+_failed = set()  # do not retry a broken build in every request
+_builds = {}  # running souffle -o process -> its build directory
+
+def souffle_version():
+    global _version
+    if _version is None:
+        try:
+            out = subprocess.run(["souffle", "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            _version = out.stdout.strip()
+        except OSError:
+            _version = ""
+    return _version
+
+def macros(precision=FULL_PRECISION):
+    return OUTPUT_PROFILES[configs.output_profile] + PRECISION_LEVELS[precision]
+
+def macro_args(precision=FULL_PRECISION):
+    return ["-M", " ".join(macros(precision))] if macros(precision) else []
+
+def program_key(precision=FULL_PRECISION):
+    h = hashlib.sha256()
+    with open(DL_PATH, "rb") as f:
+        h.update(f.read())
+    h.update(souffle_version().encode())
+    h.update(" ".join(macros(precision)).encode())
+    return h.hexdigest()[:16]
+
+def input_relations():
+    """Relations main.dl reads from the fact directory."""
+    global _inputs
+    if _inputs is None:
+        with open(DL_PATH) as f:
+            _inputs = re.findall(r"^\.input\s+(\w+)", f.read(), re.MULTILINE)
+    return _inputs
+
+def compiled_path(precision=FULL_PRECISION):
+    return os.path.join(configs.souffle_cache_dir, "main-" + program_key(precision))
+
+def compile_program(binary_path, precision=FULL_PRECISION):
+    """Compile main.dl into binary_path; the binary only appears once it is complete."""
+    os.makedirs(os.path.dirname(binary_path), exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix="build-", dir=os.path.dirname(binary_path))
+    tmp_binary = os.path.join(build_dir, "main")
+    try:
+        try:
+            # own session: the C++ compiler it runs is killed along with it, see cancel_builds
+            proc = subprocess.Popen(["souffle", "-o", tmp_binary, DL_PATH] + macro_args(precision), cwd=build_dir,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, start_new_session=True)
+        except OSError as e:
+            print("Failed to compile datalog program: " + str(e))
+            return False
+        with _compile_lock:
+            _builds[proc] = build_dir
+        try:
+            _, stderr = proc.communicate()
+        finally:
+            with _compile_lock:
+                _builds.pop(proc, None)
+        if proc.returncode != 0 or not os.path.exists(tmp_binary):
+            print("Failed to compile datalog program: " + stderr)
+            return False
+        os.replace(tmp_binary, binary_path)
+        return True
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+def cancel_builds():
+    """Kill the compilations still running and remove their build directories, at exit."""
+    with _compile_lock:
+        builds = list(_builds.items())
+    for proc, build_dir in builds:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:  # already gone
+            pass
+        proc.wait()
+        # the daemon thread of a background compilation may not get to it
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+atexit.register(cancel_builds)
+
+def compile_in_background(binary_path, precision=FULL_PRECISION):
+    if not configs.souffle_background_compile:
+        return
+    with _compile_lock:
+        if binary_path in _compiling or binary_path in _failed:
+            return
+        _compiling.add(binary_path)
+    def run():
+        ok = False
+        try:
+            ok = compile_program(binary_path, precision)
+        finally:
+            with _compile_lock:
+                _compiling.discard(binary_path)
+                if not ok:
+                    _failed.add(binary_path)
+    threading.Thread(target=run, daemon=True).start()
+
+def compile_ahead(precisions=PRECISION_LEVELS):
+    """Build the missing binaries of the given precision levels, then return the paths of those built."""
+    built = []
+    for precision in precisions:
+        binary_path = compiled_path(precision)
+        if os.access(binary_path, os.X_OK) or compile_program(binary_path, precision):
+            built.append(binary_path)
+    return built
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def cpus_per_slot():
+    # every slot of the node-wide scheduler may run a souffle at once, they share the CPUs
+    if scheduler.enabled():
+        return max(1, available_cpus() // scheduler.slots)
+    return available_cpus()
+
+def souffle_jobs(fact_path):
+    """Number of evaluation threads, configs.souffle_jobs is either a count or "auto"."""
+    if configs.souffle_jobs != "auto":
+        return max(1, int(configs.souffle_jobs))
+    # small programs reach the fixpoint before extra threads pay off
+    fact_bytes = sum(entry.stat().st_size for entry in os.scandir(fact_path) if entry.name.endswith(".facts"))
+    return max(1, min(cpus_per_slot(), 1 + fact_bytes // AUTO_JOBS_FACT_BYTES))
+
+def souffle_command(fact_path, precision=FULL_PRECISION):
+    jobs = ["-j", str(souffle_jobs(fact_path))]
+    if configs.souffle_compile:
+        binary_path = compiled_path(precision)
+        if os.access(binary_path, os.X_OK):
+            return [binary_path, "-F", fact_path, "-D", fact_path] + jobs
+        compile_in_background(binary_path, precision)
+    return ["souffle", DL_PATH, "-F", fact_path, "-D", fact_path] + macro_args(precision) + jobs
+
+if __name__ == "__main__":
+    # build the evaluators ahead of time, e.g. when deploying, for the given output profile and every precision level
+    if len(sys.argv) > 1:
+        configs.output_profile = sys.argv[1]
+    for precision in PRECISION_LEVELS:
+        print("\n".join(compile_ahead([precision])) or "Compilation failed!")
@@ -1,107 +1,222 @@
 import os, sys
 import ast
-import astunparse
 import json
+import queue
+import threading
+from array import array
 from collections import defaultdict
 from .scope import ScopeManager
+from .visitor import CachedDispatch
+
+RELATIONS = [
+    "AssignVar",
+    "AssignGlobal",
+    "AssignStrConstant",
+    "AssignBoolConstant",
+    "AssignBool",
+    "AssignIntConstant",
+    "AssignFloatConstant",
+    "AssignBinOp",
+    "AssignUnaryOp",
+    "LoadField",
+    "StoreField",
+    "StoreFieldSSA",
+    "LoadIndex",
+    "StoreIndex",
+    "StoreIndexSSA",
+    "LoadSlice",
+    "StoreSlice",
+    "StoreSliceSSA",
+    "Invoke",
+    "CallGraphEdge",
+    "ActualParam",
+    "ActualKeyParam",
+    "FormalParam",
+    "ActualReturn",
+    "FormalReturn",
+    # "MethodUpdate",
+    "VarType",
+    "SubType",
+    "VarInMethod",
+    "Alloc",
+    "LocalMethod",
+    "LocalClass",
+    "InvokeInLoop",
+    "NextInvoke",
+    "InvokeLineno",
+]
+
+class Relation(object):
+    """Facts of one relation as columns of symbol ids, duplicates are dropped as souffle would."""
+    def __init__(self) -> None:
+        self.columns = None  # one array per attribute, created with the first fact
+        self.rows = set()  # the symbol ids of a fact packed into one int
+
+    def add(self, ids):
+        if self.columns is None:
+            self.columns = [array("I") for _ in ids]
+        row = 0
+        for i in ids:
+            row = row << 32 | i
+        if row in self.rows:
+            return
+        self.rows.add(row)
+        for column, i in zip(self.columns, ids):
+            column.append(i)
 
-class FactManager(object):
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
 
+
+class BaseFactManager(object):
+    """Fresh names of invocations, variables, functions and heap objects; subclasses store the facts."""
     def __init__(self) -> None:
         self.invo_num = 0 
         self.var_num = 0
         self.func_num = 0
         self.heap_num = 0
-        self.datalog_facts = {
-            "AssignVar": [],
-            "AssignGlobal": [],
-            "AssignStrConstant": [],
-            "AssignBoolConstant": [],
-            "AssignBool": [],
-            "AssignIntConstant": [],
-            "AssignFloatConstant": [],
-            "AssignBinOp": [],
-            "AssignUnaryOp": [],
-            "LoadField": [],
-            "StoreField": [],
-            "StoreFieldSSA": [],
-            "LoadIndex": [],
-            "StoreIndex": [],
-            "StoreIndexSSA": [],
-            "LoadSlice": [],
-            "StoreSlice": [],
-            "StoreSliceSSA": [],
-            "Invoke": [],
-            "CallGraphEdge": [],
-            "ActualParam": [],
-            "ActualKeyParam": [], 
-            "FormalParam": [],
-            "ActualReturn": [],
-            "FormalReturn": [],
-            # "MethodUpdate": [],
-            "VarType": [],
-            "SubType": [],
-            "VarInMethod": [],
-            "Alloc": [],
-            "LocalMethod": [],
-            "LocalClass": [],
-            "InvokeInLoop": [],
-            "NextInvoke": [],
-            "InvokeLineno": []
-        }
-
-
-    def add_fact(self, fact_name, fact_tuple):
-        # print(fact_name, fact_tuple)
-        fact_tuple = (str(t) for t in fact_tuple)
-        self.datalog_facts[fact_name].append(fact_tuple)
+        self.namespace = ""  # infix of the fresh names, incremental.py gives each cell its own
 
     def get_new_invo(self):
         old_invo = self.invo_num
         self.invo_num += 1
-        return "$invo" + str(old_invo)
+        return "$invo" + self.namespace + str(old_invo)
 
     def get_new_var(self):
         old_var = self.var_num
         self.var_num += 1
-        return "_var" + str(old_var)
+        return "_var" + self.namespace + str(old_var)
     
     def get_new_func(self):
         old_func = self.func_num
         self.func_num += 1
-        return "_func" + str(old_func)
+        return "_func" + self.namespace + str(old_func)
 
     def get_new_heap(self):
         old_heap = self.heap_num
         self.heap_num += 1
-        return "$heap" + str(old_heap)
+        return "$heap" + self.namespace + str(old_heap)
 
     def get_new_list(self):
         old_var = self.var_num
         self.var_num += 1
-        return "$list" + str(old_var)
+        return "$list" + self.namespace + str(old_var)
 
     def get_new_tuple(self):
         old_var = self.var_num
         self.var_num += 1
-        return "$tuple" + str(old_var)
+        return "$tuple" + self.namespace + str(old_var)
 
     def get_new_set(self):
         old_var = self.var_num
         self.var_num += 1
-        return "$set" + str(old_var)
+        return "$set" + self.namespace + str(old_var)
 
     def get_new_dict(self):
         old_var = self.var_num
         self.var_num += 1
-        return "$dict" + str(old_var)
+        return "$dict" + self.namespace + str(old_var)
 
 
+class FactManager(BaseFactManager):
+    """Keeps the facts in memory, interned, until write_facts."""
+    def __init__(self) -> None:
+        super().__init__()
+        self.symbols = {}  # symbol -> id
+        self.symbol_table = []  # id -> symbol
+        self.relations = {name: Relation() for name in RELATIONS}
+
+    def intern(self, value):
+        symbol = str(value)
+        i = self.symbols.get(symbol)
+        if i is None:
+            i = self.symbols[symbol] = len(self.symbol_table)
+            self.symbol_table.append(symbol)
+        return i
+
+    def add_fact(self, fact_name, fact_tuple):
+        # print(fact_name, fact_tuple)
+        self.relations[fact_name].add([self.intern(t) for t in fact_tuple])
+
+    def rows(self, fact_name):
+        columns = self.relations[fact_name].columns or []
+        table = self.symbol_table
+        return zip(*[map(table.__getitem__, column) for column in columns])
+
+    @property
+    def datalog_facts(self):
+        return {name: list(self.rows(name)) for name in self.relations}
+
+    def write_facts(self, fact_path):
+        """Write <relation>.facts for every relation, empty ones included since souffle reads them all."""
+        for name in self.relations:
+            with open(os.path.join(fact_path, name + ".facts"), "w") as f:
+                f.write("\n".join(map("\t".join, self.rows(name))))
+
+    def close(self):
+        pass
+
+
+class StreamingFactManager(BaseFactManager):
+    """
+    Writes the facts into <fact_path>/<relation>.facts while they are generated: rows are buffered
+    up to buffer_bytes, then handed to a writer thread, so memory does not grow with the program.
+    Facts are neither interned nor deduplicated, souffle drops the duplicates.
+    """
+    def __init__(self, fact_path, buffer_bytes) -> None:
+        super().__init__()
+        self.buffer_bytes = buffer_bytes
+        self.buffers = {name: [] for name in RELATIONS}
+        self.buffered = 0
+        self.files = {name: open(os.path.join(fact_path, name + ".facts"), "w") for name in RELATIONS}
+        self.chunks = queue.Queue(maxsize=2)  # flushed buffers on their way to disk
+        self.error = None
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
 
-class FactGenerator(ast.NodeVisitor):
-    def __init__(self, json_path) -> None:
+    def add_fact(self, fact_name, fact_tuple):
+        line = "\t".join([str(t) for t in fact_tuple]) + "\n"
+        self.buffers[fact_name].append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        self.chunks.put([(name, "".join(lines)) for name, lines in self.buffers.items() if lines])
+        self.buffers = {name: [] for name in RELATIONS}
+        self.buffered = 0
+
+    def write_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if self.error:  # keep draining so that flush never blocks
+                continue
+            try:
+                for name, data in chunk:
+                    self.files[name].write(data)
+            except OSError as e:
+                self.error = e
+
+    def write_facts(self, fact_path):
+        self.flush()
+        self.close()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        if self.writer.is_alive():
+            self.chunks.put(None)
+            self.writer.join()
+        for f in self.files.values():
+            f.close()
+
+
+class FactGenerator(CachedDispatch, ast.NodeVisitor):
+    def __init__(self, json_path, fact_manager=None) -> None:
         super().__init__()
-        self.FManager = FactManager()
+        self.FManager = fact_manager or FactManager()
         self.scopeManager = ScopeManager()
         self.load_type_map(json_path)
         self.meth_map = {
@@ -1,18 +1,17 @@
 import ast
 from collections import defaultdict
 from .scope import ScopeManager
+from .visitor import CachedDispatch
 
-class GlobalCollector(ast.NodeVisitor):
+class GlobalCollector(CachedDispatch, ast.NodeVisitor):
+    """
+    Names that must keep their name in the IR. This stays a pass of its own: a function further down
+    can declare any module name global, and lowering renames every name from its first appearance.
+    """
     def __init__(self) -> None:
         super().__init__()
         self.scopeManager = ScopeManager()
         self.globals = set() # set of variables that should not be renamed
-    
-    def visit(self, node):
-        """Visit a node."""
-        method = 'visit_' + node.__class__.__name__
-        visitor = getattr(self, method, self.generic_visit)
-        return visitor(node)
 
     def generic_visit(self, node):
         return ast.NodeVisitor.generic_visit(self, node)
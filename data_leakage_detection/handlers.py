@@ -1,132 +1,227 @@
 import os
 import json
+import hashlib
+import threading
 
 from jupyter_server.base.handlers import APIHandler
 from jupyter_server.utils import url_path_join
 
 import tornado
 from tornado.web import StaticFileHandler
+from tornado.ioloop import IOLoop
 
-from .main import main
+from .jobs import job_manager
+from .scheduler import scheduler
+from . import notebook
+from . import inference, datalog
+from .workspace import Workspace
+from .cache import result_cache
+from .metrics import metrics
+from .config import configs
 
-class RouteHandler(APIHandler):
-    # The following decorator should be present on all verb methods (head, get, post,
-    # patch, put, delete, options) to ensure only authorized user can request the
-    # Jupyter server
-    @tornado.web.authenticated
-    def post(self):
-        # input_data is a dictionary with a key "name"
-        input_data = self.get_json_body()
-        input_file_name = input_data["name"]
-        abs_file_path = os.path.join(os.getcwd(), input_file_name)
-        # check file type
-        analysis_path = abs_file_path
-        file_prefix, file_suffix = os.path.splitext(input_file_name)
-        if file_suffix == '.ipynb':
-            # generate a temporary script file from notebook
-            # TODO: if name is occupied, nbconvert seems not generating
-            # Or "python3 -m jupyter ..."
-            os.system(f"jupyter nbconvert --to script {abs_file_path}")  # TODO: if failed
-            analysis_path = os.path.join(os.getcwd(), file_prefix) + '.py'
-        result = main(analysis_path)
-
-        # [{'Line': 78, 'Label': 'train', 'Tags': [{'Tag': 'no_test', 'Source': []}]}]
-        # first go through warning suppression layer:
-        # better not delete item while iterating
-        def suppress_warnings(report, file_path):
-            lines = []
-            with open(file_path) as file:
-                for line in file:
-                    lines.append(line.rstrip())
-            suppressed_lines = set()
-            for i in range(len(lines)):
-                if "@suppressLeakWarning" in lines[i]:
-                    suppressed_lines.add(i)
-            entry_to_mute = set()  # entry.Line values to delete
-            line2other = dict()
-            line2entry = dict()
-            for entry in report:
-                line2entry[entry['Line']] = entry
-                for tag in entry['Tags']:
-                    if tag['Tag'] == 'train-test' or tag['Tag'] == 'test-train':
-                        line2other[tag['Source'][0]] = tag['Source'][1]
-                        line2other[tag['Source'][1]] = tag['Source'][0]
-            for entry in report:
-                # entry is like: {'Line': 18, 'Label': 'train', 'Tags': [{'Tag': 'train-test', 'Source': [18, 19]}]}
-                if entry['Line'] - 1 in suppressed_lines:
-                    entry_to_mute.add(entry['Line'])
-                    # set the corresponding other train/test entry to suppressed, if exists
-                    if entry['Line'] in line2other:
-                        entry_to_mute.add(line2other[entry['Line']])
-                else:  # look into its sources
-                    # delete suppressed sources
-                    new_tags = []
-                    for tag in entry['Tags']:
-                        if tag['Tag'] != 'train-test' and tag['Tag'] != 'test-train':
-                            new_sources = []
-                            for source in tag['Source']:
-                                if source - 1 in suppressed_lines:
-                                    continue
-                                new_sources.append(source)
-                            if len(new_sources) != 0 or len(tag['Source']) == 0:  # for those originally with empty source: {'Tag': 'no_test', 'Source': []}
-                                tag['Source'] = new_sources
-                                new_tags.append(tag)
-                        else:
-                            new_tags.append(tag)
-                    entry['Tags'] = new_tags
-                    # mark the pair if no extra source for both
-                    if len(new_tags) < 2 and entry['Line'] in line2other and len(line2entry[line2other[entry['Line']]]['Tags']) < 2:
-                        # get the other entry of this pair
-                        entry_to_mute.add(entry['Line'])
-                        entry_to_mute.add(line2other[entry['Line']])
-            # end for entry in report
-            new_report = []
-            for entry in report:
-                if entry['Line'] not in entry_to_mute:
-                    new_report.append(entry)
-                                
-            return new_report
-
-        def ipynb_line_transform(report, file_path):  # transform 1-indiced line_no to cell_no and line_no
-            lines = []
-            with open(file_path) as file:
-                for line in file:
-                    lines.append(line.rstrip())
-            # get the line_no of "# In[..." following with 2 "\n" in py file
-            splits = []
-            for i in range(len(lines)):
-                if lines[i][:5] == "# In[" and i + 2 < len(lines) and\
-                lines[i + 1] == "" and lines[i + 2] == "":  # '\n' has been stripped
-                    splits.append(i + 1)  # 1-indiced
-            for entry in report:
-                # entry is like: {'Line': 18, 'Label': 'train', 'Tags': [{'Tag': 'train-test', 'Source': [18, 19]}]}
-                def line2cell(splits, lineno):
-                    for i in range(len(splits)):
-                        if lineno < splits[i]:
-                            return i - 1, lineno - splits[i - 1] - 3
-                    return len(splits) - 1, lineno - splits[-1] - 3
-                cell, line = line2cell(splits, entry['Line'])
-                entry['Location'] = {'Cell': cell, 'Line': line}
-                for tag in entry['Tags']:
-                    sources = []
+# [{'Line': 78, 'Label': 'train', 'Tags': [{'Tag': 'no_test', 'Source': []}]}]
+# first go through warning suppression layer:
+# better not delete item while iterating
+def suppress_warnings(report, file_path):
+    lines = []
+    with open(file_path) as file:
+        for line in file:
+            lines.append(line.rstrip())
+    suppressed_lines = set()
+    for i in range(len(lines)):
+        if "@suppressLeakWarning" in lines[i]:
+            suppressed_lines.add(i)
+    entry_to_mute = set()  # entry.Line values to delete
+    line2other = dict()
+    line2entry = dict()
+    for entry in report:
+        line2entry[entry['Line']] = entry
+        for tag in entry['Tags']:
+            if tag['Tag'] == 'train-test' or tag['Tag'] == 'test-train':
+                line2other[tag['Source'][0]] = tag['Source'][1]
+                line2other[tag['Source'][1]] = tag['Source'][0]
+    for entry in report:
+        # entry is like: {'Line': 18, 'Label': 'train', 'Tags': [{'Tag': 'train-test', 'Source': [18, 19]}]}
+        if entry['Line'] - 1 in suppressed_lines:
+            entry_to_mute.add(entry['Line'])
+            # set the corresponding other train/test entry to suppressed, if exists
+            if entry['Line'] in line2other:
+                entry_to_mute.add(line2other[entry['Line']])
+        else:  # look into its sources
+            # delete suppressed sources
+            new_tags = []
+            for tag in entry['Tags']:
+                if tag['Tag'] != 'train-test' and tag['Tag'] != 'test-train':
+                    new_sources = []
                     for source in tag['Source']:
-                        cell, line = line2cell(splits, source)
-                        sources.append({'Cell': cell, 'Line': line})
-                    tag['Source'] = sources
-            return report
+                        if source - 1 in suppressed_lines:
+                            continue
+                        new_sources.append(source)
+                    if len(new_sources) != 0 or len(tag['Source']) == 0:  # for those originally with empty source: {'Tag': 'no_test', 'Source': []}
+                        tag['Source'] = new_sources
+                        new_tags.append(tag)
+                else:
+                    new_tags.append(tag)
+            entry['Tags'] = new_tags
+            # mark the pair if no extra source for both
+            if len(new_tags) < 2 and entry['Line'] in line2other and len(line2entry[line2other[entry['Line']]]['Tags']) < 2:
+                # get the other entry of this pair
+                entry_to_mute.add(entry['Line'])
+                entry_to_mute.add(line2other[entry['Line']])
+    # end for entry in report
+    new_report = []
+    for entry in report:
+        if entry['Line'] not in entry_to_mute:
+            new_report.append(entry)
+                        
+    return new_report
+
+
+def ipynb_line_transform(report, cell_map):  # transform 1-indiced line_no to cell_no and line_no
+    for entry in report:
+        # entry is like: {'Line': 18, 'Label': 'train', 'Tags': [{'Tag': 'train-test', 'Source': [18, 19]}]}
+        cell, line = cell_map.locate(entry['Line'])
+        entry['Location'] = {'Cell': cell, 'Line': line}
+        for tag in entry['Tags']:
+            sources = []
+            for source in tag['Source']:
+                cell, line = cell_map.locate(source)
+                sources.append({'Cell': cell, 'Line': line})
+            tag['Source'] = sources
+    return report
 
-        data = {'ok': False, 'report': [], 'log': ''}
+
+def load_engine():
+    # the analysis pulls in pandas, pygments and the whole front end, servers only pay for it when used
+    from .main import main
+    return main
+
+def prewarm_engine():
+    threading.Thread(target=load_engine, name="prewarm", daemon=True).start()
+
+
+def analyze(job, input_file_name, root_dir, cells=None):
+    abs_file_path = os.path.join(root_dir, input_file_name)
+    # check file type
+    analysis_path = abs_file_path
+    file_prefix, file_suffix = os.path.splitext(input_file_name)
+    cache_key = None
+    if configs.result_cache:
+        # the whole answer only depends on the file content (or the cells sent), skip nbconvert as well
+        if cells is not None:
+            cache_key = result_cache.key(json.dumps(cells, sort_keys=True).encode(), "detect", "cells")
+        else:
+            with open(abs_file_path, "rb") as f:
+                cache_key = result_cache.key(f.read(), "detect", file_suffix)
+        data = result_cache.get(cache_key)
+        if data is not None:
+            return data
+    # intermediate files stay in a directory of the job, next to nothing of the user's
+    with Workspace() as ws:
+        cell_map = None
+        script_path = ws.file(os.path.basename(file_prefix) + '.py')
+        if cells is not None:
+            job.enter_stage("nbconvert")
+            # the unsaved notebook on screen, the file on disk is not read
+            analysis_path = script_path
+            cell_map = notebook.write_script({"cells": cells}, analysis_path)
+        elif file_suffix == '.ipynb':
+            job.enter_stage("nbconvert")
+            # generate a temporary script file from notebook, in the layout of nbconvert
+            analysis_path = script_path
+            cell_map = notebook.convert(abs_file_path, analysis_path)
+        # stages over their budget are rerun at a lower precision, the report says which
+        full_precision = {'inference': inference.FULL_PRECISION, 'datalog': datalog.FULL_PRECISION}
+        precision = dict(full_precision)
+        result = load_engine()(analysis_path, progress=job.enter_stage, work_dir=ws.path, name=abs_file_path,
+                               waiting=job.wait_for_slot, precision=precision.__setitem__)
+
+        data = {'ok': False, 'report': [], 'log': '', 'precision': precision,
+                'degraded': [stage for stage in precision if precision[stage] != full_precision[stage]]}
         if not isinstance(result, str):  # if no error
+            job.enter_stage("postprocess")
             #report_file_name = file_prefix + '.html'
             result = suppress_warnings(result, analysis_path)
-            if file_suffix == '.ipynb':
-                result = ipynb_line_transform(result, analysis_path)
+            if cell_map is not None:
+                result = ipynb_line_transform(result, cell_map)
             data['ok'] = True
             data['report'] = result
             data['log'] = ""
-            # if file_suffix == '.ipynb':
-            #     os.remove(analysis_path)
-        self.finish(json.dumps(data))
+            if cache_key and not data['degraded']:  # a rerun may stay within budget
+                result_cache.put(cache_key, data)
+        else:
+            data['log'] = result
+    return data
+
+
+def content_key(abs_file_path, cells=None):
+    # what a job analyzes: identical requests share a job, a new version of the file cancels the old one
+    if cells is not None:
+        return hashlib.sha256(json.dumps(cells, sort_keys=True).encode()).hexdigest()
+    try:
+        with open(abs_file_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class RouteHandler(APIHandler):
+    # The following decorator should be present on all verb methods (head, get, post,
+    # patch, put, delete, options) to ensure only authorized user can request the
+    # Jupyter server
+    @tornado.web.authenticated
+    async def post(self):
+        # input_data is a dictionary with a key "name", and optionally "cells": the live notebook cells
+        input_data = self.get_json_body()
+        input_file_name = input_data["name"]
+        cells = input_data.get("cells")
+        if cells is not None and not notebook.valid_cells(cells):
+            raise tornado.web.HTTPError(400, "cells must be a list of {cell_type, source}")
+        # the pipeline runs on the worker pool, clients poll GET detect/<job>
+        root_dir = os.getcwd()
+        # hashing the notebook and reading the node-wide queue touch the disk, off the IOLoop
+        loop = IOLoop.current()
+        key = await loop.run_in_executor(None, content_key, os.path.join(root_dir, input_file_name), cells)
+        if job_manager.attach(input_file_name, key) is None:
+            backlog = await loop.run_in_executor(None, scheduler.backlog)
+            if scheduler.saturated(backlog):
+                # the node is busy with heavy stages of other jobs, ask the client to come back later
+                self.set_status(503)
+                self.set_header("Retry-After", str(scheduler.retry_after(backlog)))
+                self.finish(json.dumps({'status': 'saturated', 'waiting': backlog}))
+                return
+        job = job_manager.submit(input_file_name, analyze, input_file_name, root_dir, cells, key=key)
+        self.set_status(202)
+        self.finish(json.dumps(job.to_dict()))
+
+
+class JobHandler(APIHandler):
+    @tornado.web.authenticated
+    def get(self, job_id):
+        job = job_manager.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, f"Unknown job {job_id}")
+        self.finish(json.dumps(job.to_dict()))
+
+    @tornado.web.authenticated
+    def delete(self, job_id):
+        # e.g. the tab was closed: the job stops and its pyright and souffle processes are killed
+        job = job_manager.cancel(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, f"Unknown job {job_id}")
+        self.finish(json.dumps(job.to_dict()))
+
+
+class MetricsHandler(APIHandler):
+    @tornado.web.authenticated
+    def get(self):
+        # ?format=prometheus for scrapers, JSON otherwise
+        if self.get_argument("format", "json") == "prometheus":
+            # APIHandler.finish would reset the Content-Type to JSON
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            tornado.web.RequestHandler.finish(self, metrics.to_prometheus())
+        else:
+            self.finish(json.dumps(metrics.to_dict()))
 
 
 def setup_handlers(web_app):
@@ -135,10 +230,15 @@ def setup_handlers(web_app):
 
     base_url = web_app.settings["base_url"]
     route_pattern = url_path_join(base_url, url_path, "detect")
-    handlers = [(route_pattern, RouteHandler)]
+    job_pattern = url_path_join(base_url, url_path, "detect", "([0-9a-f]+)")
+    metrics_pattern = url_path_join(base_url, url_path, "metrics")
+    handlers = [(route_pattern, RouteHandler), (job_pattern, JobHandler), (metrics_pattern, MetricsHandler)]
     web_app.add_handlers(host_pattern, handlers)
 
     doc_url = url_path_join(base_url, url_path, "report")
     doc_dir = os.getcwd()
     handlers = [("{}/(.*)".format(doc_url), StaticFileHandler, {"path": doc_dir})]  # local root dir of content
     web_app.add_handlers(".*$", handlers)
+
+    if configs.prewarm_delay is not None:
+        IOLoop.current().call_later(configs.prewarm_delay, prewarm_engine)
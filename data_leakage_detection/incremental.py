@@ -0,0 +1,218 @@
+import ast
+import pickle
+import hashlib
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from .irgen import CodeTransformer, injected_defs
+from .metrics import metrics
+from .config import configs
+
+'''
+Incremental lowering of notebook scripts
+
+A top-level cell can only read and write the renaming state (ScopeManager) of the identifiers it mentions:
+blocks it opens get fresh contexts, and its temporaries, lambdas and blocks are named in a namespace of
+its own, derived from its code, so they never meet those of other cells and inserting or editing a cell
+leaves the names in the others unchanged. A cell whose code and projection of the state are the same as
+in the previous analysis of the notebook reuses its IR and replays its recorded effect on that projection,
+so after an edit only the edited cell and the downstream cells whose renamings changed are lowered again.
+Facts are not reused per cell: they depend on the types pyright infers for the whole program, so type
+inference, fact generation and souffle see the whole program and are reused through the artifact store.
+
+Comparing and restoring the whole state instead costs a hash and a pickle of all of it per cell, which
+is quadratic in the number of cells. The price is that state a cell leaves for later ones, when added to
+ScopeManager, must also be added to project and replay, or edits reuse stale IR.
+'''
+
+def split_cells(lines):
+    """1-indexed line numbers of the "# In[ ]:" headers written by nbconvert, as in ipynb_line_transform."""
+    starts = []
+    for i in range(len(lines)):
+        if lines[i][:5] == "# In[" and i + 2 < len(lines) and\
+        lines[i + 1].strip() == "" and lines[i + 2].strip() == "":
+            starts.append(i + 1)
+    return starts
+
+def cell_names(stmts):
+    """Identifiers of a cell, the keys of the renaming state it may touch."""
+    names = set()
+    for stmt in stmts:
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name):
+                names.add(node.id)
+            elif isinstance(node, ast.arg):
+                names.add(node.arg)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.add(node.name)
+            elif isinstance(node, ast.alias):
+                names.add(node.name)
+                if node.asname:
+                    names.add(node.asname)
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                names.update(node.names)
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                names.add(node.name)
+            elif isinstance(node, ast.keyword) and node.arg:
+                names.add(node.arg)
+    return frozenset(names)
+
+def cell_sigs(sm, names):
+    # signatures of functions and classes named in the cell, and of the module
+    return sorted(sig for sig in set(sm.locals) | set(sm.globalOrNonloacls)
+                  if sig == "" or all(part in names for part in sig.split(".")))
+
+def module_frames(sm):
+    # frames that outlive a top-level cell: the module and the block the cells are lowered in
+    return (sm.root, sm.root.child("ctx0"))
+
+def project(v, names):
+    """The part of the renaming state a top-level cell with these identifiers reads and writes."""
+    sm = v.scopeManager
+    frames = module_frames(sm)
+    entries = []
+    for name in sorted(names):
+        entries.append((
+            name,
+            sm.name_nextid_map.get(name),
+            tuple(frame.names.get(name) for frame in frames),
+            tuple(name in frame.defined for frame in frames),
+            tuple(name in frame.updated for frame in frames),
+            name in sm.defined_names,
+            name in sm.ignored_vars,
+            sm.arg_map.get(name),
+        ))
+    sigs = tuple((sig, tuple(sorted(sm.locals.get(sig, set()) & names)), tuple(sorted(sm.globalOrNonloacls.get(sig, set()) & names)))
+                 for sig in cell_sigs(sm, names))
+    return tuple(entries), sigs
+
+def replay(v, names, projection):
+    """Bring the state to what lowering the cell would have left, as far as later cells can observe."""
+    sm = v.scopeManager
+    entries, sigs = projection
+    def assign(mapping, key, value):
+        if value is None:
+            mapping.pop(key, None)
+        else:
+            mapping[key] = value
+    def include(members, name, flag):
+        if flag:
+            members.add(name)
+        else:
+            members.discard(name)
+    for name, nextid, mapped, defined, updated, is_defined_name, _, args in entries:
+        assign(sm.name_nextid_map, name, nextid)
+        for frame, value, is_defined, is_updated in zip(module_frames(sm), mapped, defined, updated):
+            assign(frame.names, name, value)
+            include(frame.defined, name, is_defined)
+            include(frame.updated, name, is_updated)
+        include(sm.defined_names, name, is_defined_name)
+        assign(sm.arg_map, name, args)
+    for sig, local_names, global_names in sigs:
+        local_names, global_names = set(local_names), set(global_names)
+        for name in names:
+            include(sm.locals[sig], name, name in local_names)
+            include(sm.globalOrNonloacls[sig], name, name in global_names)
+
+def enter_namespace(v, namespace):
+    # fresh names of the cell are numbered from 0 in its namespace
+    sm, fm = v.scopeManager, v.FManager
+    sm.namespace = fm.namespace = namespace
+    sm.ctx_num = fm.invo_num = fm.var_num = fm.func_num = fm.heap_num = 0
+
+def shift_lineno(stmts, delta):
+    for stmt in stmts:
+        for node in ast.walk(stmt):
+            if getattr(node, "lineno", None) is not None:
+                node.lineno += delta
+            if getattr(node, "end_lineno", None) is not None:
+                node.end_lineno += delta
+
+
+class CellRecord(object):
+    def __init__(self, code_hash, namespace, names, entry, start, ir, exit) -> None:
+        self.code_hash = code_hash
+        self.namespace = namespace  # of the fresh names in ir
+        self.names = names
+        self.entry = entry  # projection of the state before the cell
+        self.start = start  # header line when the record was made
+        self.ir = ir  # pickled, callers mutate the IR
+        self.exit = exit  # projection of the state after the cell
+
+
+class CellCache(object):
+    def __init__(self, max_notebooks) -> None:
+        self.max_notebooks = max_notebooks
+        self.records = OrderedDict()  # notebook key -> [CellRecord]
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.records:
+                return []
+            self.records.move_to_end(key)
+            return self.records[key]
+
+    def put(self, key, records):
+        with self.lock:
+            self.records[key] = records
+            self.records.move_to_end(key)
+            while len(self.records) > self.max_notebooks:
+                self.records.popitem(last=False)
+
+    def transform(self, key, tree, lines, ignored_vars):
+        """Lower the module like CodeTransformer.visit_Module, cell by cell; None if the source has no cells."""
+        starts = split_cells(lines)
+        if not starts:
+            return None
+        cells = [[] for _ in starts]
+        prologue = []  # code before the first header
+        for stmt in tree.body:
+            i = bisect_right(starts, stmt.lineno) - 1
+            (cells[i] if i >= 0 else prologue).append(stmt)
+        bounds = starts + [len(lines) + 1]
+
+        # cells are matched by namespace, so that those after an inserted or deleted cell are found again
+        old_records = {record.namespace: record for record in self.get(key)}
+        new_records = []
+        v = CodeTransformer(ignored_vars)
+        body = injected_defs()
+        v.scopeManager.enterBlock()
+        body += v.visit_Statements(prologue)
+        lowered = 0
+        namespaces = set()
+        for i, stmts in enumerate(cells):
+            code = "\n".join(lines[bounds[i]:bounds[i + 1] - 1])
+            code_hash = hashlib.sha256(code.encode()).digest()
+            # cells of the same code, or of the same hash prefix, get the next free namespace
+            namespace, n = code_hash.hex()[:8] + "_", 0
+            while namespace in namespaces:
+                n += 1
+                namespace = code_hash.hex()[:8] + "_" + str(n) + "_"
+            namespaces.add(namespace)
+            enter_namespace(v, namespace)
+            old = old_records.get(namespace)
+            same_code = old is not None and old.code_hash == code_hash
+            names = old.names if same_code else cell_names(stmts)
+            entry = project(v, names)
+            if same_code and old.entry == entry:
+                ir = pickle.loads(old.ir)
+                if starts[i] != old.start:
+                    shift_lineno(ir, starts[i] - old.start)
+                replay(v, names, old.exit)
+                new_records.append(old)
+            else:
+                ir = v.visit_Statements(stmts)
+                lowered += 1
+                new_records.append(CellRecord(code_hash, namespace, names, entry, starts[i], pickle.dumps(ir), project(v, names)))
+            body += ir
+        v.scopeManager.leaveBlock()
+        tree.body = body
+        print(f"Lowered {lowered} of {len(cells)} cells")
+        metrics.inc("cells_total", lowered, help="Notebook cells by lowering outcome", result="lowered")
+        metrics.inc("cells_total", len(cells) - lowered, help="Notebook cells by lowering outcome", result="reused")
+        self.put(key, new_records)
+        return tree
+
+
+cell_cache = CellCache(configs.incremental_notebooks)
@@ -0,0 +1,166 @@
+import os
+import json
+import queue
+import atexit
+import time
+import threading
+import subprocess
+from . import procs
+from .config import configs
+
+'''
+Client for inference_server.js, a warm pyright process shared by consecutive analyses
+'''
+POLL_INTERVAL = 0.2  # seconds between two checks for cancellation while waiting for a reply
+SERVER_PATH = os.path.join(os.path.dirname(__file__), "inference_server.js")
+UNSUPPORTED = 64  # exit code of a server whose pyright bundle does not export main()
+# pyright arguments of each precision level of a one-shot run, from the most precise; warm servers run the first
+PRECISION_LEVELS = {
+    "library": ["--lib"],  # types inferred from library sources when they have no stubs
+    "stubs": [],  # types from stubs only, much less to analyze
+}
+FULL_PRECISION = next(iter(PRECISION_LEVELS))
+
+class InferenceServer(object):
+    def __init__(self, inference_path, server_path) -> None:
+        self.inference_path = inference_path
+        self.server_path = server_path
+        self.proc = None
+        self.replies = None
+        self.request_num = 0
+        self.served = 0  # requests answered by the current process
+        self.unsupported = False  # the bundle cannot serve requests, do not restart the server for each of them
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self, memory_bytes=None):
+        self.proc = subprocess.Popen(["node", self.server_path, self.inference_path],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     text=True, bufsize=1, start_new_session=True)
+        procs.set_limits(self.proc.pid, None, memory_bytes)
+        self.served = 0
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_replies, args=(self.proc, self.replies), daemon=True).start()
+
+    @staticmethod
+    def read_replies(proc, replies):
+        for line in proc.stdout:
+            try:
+                replies.put(json.loads(line))
+            except ValueError:
+                continue
+        replies.put(None)  # server is gone
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def limit_cpu(self, cpu_seconds):
+        # RLIMIT_CPU counts the whole life of the server, each request gets cpu_seconds more than it has used
+        used = procs.cpu_time(self.proc.pid) if cpu_seconds else None
+        if used is not None:
+            procs.set_limits(self.proc.pid, int(used) + cpu_seconds, None)
+
+    def worn_out(self, max_requests, max_rss_bytes):
+        # pyright.main keeps some of its state from one run to the next, the memory of the process only grows
+        if max_requests and self.served >= max_requests:
+            return True
+        rss = procs.rss(self.proc.pid) if max_rss_bytes else None
+        return rss is not None and rss > max_rss_bytes
+
+    def infer(self, ir_path, json_path, timeout, cpu_seconds=None, memory_bytes=None, max_requests=None, max_rss_bytes=None):
+        """
+        Run type inference for ir_path under the budgets of a one-shot run and return a procs.Completed, over budget
+        when the server ran out of time or was killed by its rlimits. None when it could not serve the request,
+        failed or wrote no type map at json_path, for the caller to run pyright once instead.
+        The server is restarted after max_requests replies, or once its resident memory exceeds max_rss_bytes.
+        """
+        if self.unsupported:
+            return None
+        # only the type map of this request counts
+        try:
+            os.unlink(json_path)
+        except FileNotFoundError:
+            pass
+        if not self.alive():
+            self.start(memory_bytes)
+        self.limit_cpu(cpu_seconds)
+        self.request_num += 1
+        request_id = self.request_num
+        args = ["node", self.server_path, ir_path]
+        limited = procs.resource is not None and bool(cpu_seconds or memory_bytes)
+        st = time.monotonic()
+        try:
+            self.proc.stdin.write(json.dumps({"id": request_id, "path": ir_path}) + "\n")
+            self.proc.stdin.flush()
+            deadline = st + timeout
+            while time.monotonic() < deadline:
+                if procs.cancelled():
+                    # the server would go on with the stale request, and keep the next job waiting
+                    break
+                try:
+                    reply = self.replies.get(timeout=min(POLL_INTERVAL, max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    continue
+                if reply is None:
+                    returncode = self.proc.wait()
+                    self.unsupported = returncode == UNSUPPORTED
+                    died = procs.Completed(args, returncode, "", "", time.monotonic() - st, limited=limited)
+                    if died.over_budget:  # a one-shot run would go the same way
+                        self.stop()
+                        return died
+                    break
+                if reply.get("id") == request_id:
+                    self.served += 1
+                    if self.worn_out(max_requests, max_rss_bytes):
+                        self.stop()
+                    if not reply.get("ok", False) or not os.path.exists(json_path):
+                        return None
+                    return procs.Completed(args, 0, "", "", time.monotonic() - st)
+                # stale reply of a request we gave up on
+            else:
+                self.stop()
+                return procs.Completed(args, None, "", "", time.monotonic() - st, timed_out=True)
+        except OSError:
+            pass
+        # dead, confused or cancelled: restart on next request
+        self.stop()
+        return None
+
+
+class InferenceServerPool(object):
+    def __init__(self, size, inference_path, server_path) -> None:
+        self.servers = queue.Queue()
+        for _ in range(size):
+            self.servers.put(InferenceServer(inference_path, server_path))
+        self.all_servers = list(self.servers.queue)
+
+    def infer(self, ir_path, json_path, timeout, *limits):
+        server = self.servers.get()
+        try:
+            return server.infer(ir_path, json_path, timeout, *limits)
+        except OSError:  # e.g. node is missing
+            server.stop()
+            return None
+        finally:
+            self.servers.put(server)
+
+    def shutdown(self):
+        for server in self.all_servers:
+            server.stop()
+
+
+server_pool = InferenceServerPool(configs.max_workers, configs.inference_path, SERVER_PATH)
+atexit.register(server_pool.shutdown)
+
+
+def infer(ir_path, json_path):
+    """Infer types through a warm server, see InferenceServer.infer; None means the caller should fall back to one-shot mode."""
+    if not configs.inference_server:
+        return None
+    return server_pool.infer(ir_path, json_path, configs.inference_timeout, configs.inference_cpu_seconds,
+                             configs.inference_memory_bytes, configs.inference_server_max_requests,
+                             configs.inference_server_max_rss_bytes)
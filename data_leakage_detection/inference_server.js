@@ -0,0 +1,84 @@
+#!/usr/bin/env node
+/*
+ * Long-lived type inference server.
+ *
+ * Keeps node and the pyright bundle loaded between analyses instead of paying
+ * both for every file. Usage: node inference_server.js <pyright/index.js>
+ *
+ * Protocol: one JSON request per line on stdin, e.g. {"id": 3, "path": "/x/a.py.ir.py"},
+ * one JSON reply per line on stdout, e.g. {"id": 3, "ok": true, "code": 1}.
+ * The type map is written next to the IR file, exactly like `node index.js <path> --lib`;
+ * as with the one-shot CLI, code 1 only means pyright reported type errors, higher codes are
+ * failures and reply ok: false. The bundle must export main(), the CLI entry point.
+ */
+const path = require('path');
+const readline = require('readline');
+
+const inferencePath = path.resolve(process.argv[2]);
+const pyrightDir = path.dirname(inferencePath);
+const bundlePath = path.join(pyrightDir, 'dist', 'pyright');
+// exit code telling the client that the bundle cannot serve several runs, see inference.py
+const UNSUPPORTED = 64;
+// pyright exit codes above this one are crashes or bad arguments, not type errors
+const ERRORS_REPORTED = 1;
+
+// pyright reports on stdout, which is our reply channel
+const writeReply = process.stdout.write.bind(process.stdout);
+process.stdout.write = (chunk, encoding, callback) => process.stderr.write(chunk, encoding, callback);
+
+// pyright ends every run with process.exit: the run in progress gets the code, exits outside a run are dropped
+const realExit = process.exit;
+let finishRun = null;
+process.exit = code => {
+  if (finishRun) {
+    finishRun(code === undefined ? 0 : code);
+  }
+};
+
+// same setup as pyright's own index.js; a CLI bundle runs main() as soon as it is loaded,
+// with our own arguments, so it gets --version instead and its exit is dropped
+global.__rootDirectory = path.join(pyrightDir, 'dist') + path.sep;
+const serverArgv = process.argv;
+process.argv = [serverArgv[0], inferencePath, '--version'];
+const pyright = require(bundlePath);
+process.argv = serverArgv;
+if (typeof pyright.main !== 'function') {
+  process.stderr.write(bundlePath + ' does not export main(), every file needs a one-shot pyright\n');
+  realExit(UNSUPPORTED);
+}
+
+// run the pyright CLI once in this process, resolving with its exit code
+function inferOnce(irPath) {
+  return new Promise(resolve => {
+    finishRun = resolve;
+    process.argv = [serverArgv[0], inferencePath, irPath, '--lib'];
+    try {
+      Promise.resolve(pyright.main()).catch(() => resolve(ERRORS_REPORTED + 1));
+    } catch (e) {
+      resolve(ERRORS_REPORTED + 1);
+    }
+  }).finally(() => {
+    finishRun = null;
+  });
+}
+
+// requests are served one at a time, pyright relies on process-wide state
+let pending = Promise.resolve();
+
+const rl = readline.createInterface({ input: process.stdin });
+rl.on('line', line => {
+  let request;
+  try {
+    request = JSON.parse(line);
+  } catch (e) {
+    writeReply(JSON.stringify({ id: null, ok: false, error: 'bad request' }) + '\n');
+    return;
+  }
+  pending = pending.then(async () => {
+    const code = await inferOnce(request.path);
+    writeReply(JSON.stringify({ id: request.id, ok: code <= ERRORS_REPORTED, code: code }) + '\n');
+  });
+});
+rl.on('close', () => {
+  pending.then(() => realExit(0));
+});
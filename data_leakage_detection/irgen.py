@@ -1,4 +1,5 @@
 import os, sys
+import io
 import ast
 import copy
 import astunparse
@@ -6,6 +7,7 @@ import json
 from collections import defaultdict
 from .scope import ScopeManager
 from .factgen import FactManager
+from .visitor import CachedDispatch
 
 # definition of injected functions, for the convience of type checking
 phi_def_code = '''
@@ -24,59 +26,66 @@ def global_wrapper(x):
 
 '''
 
+def injected_defs():
+    # the injected functions have no source lines
+    tree = ast.parse(phi_def_code)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.stmt):
+            node.lineno = None
+    return tree.body
+
 '''
 Transform code to a simpler IR, which is easier to translate to datalog facts
 The exact semantics may not be equivalent
 '''
-class CodeTransformer(ast.NodeTransformer):
+class CodeTransformer(CachedDispatch, ast.NodeTransformer):
+    unchanged_nodeclasses = frozenset([ast.Global, ast.Nonlocal, ast.Pass, ast.Break, ast.Continue, ast.Import, ast.ImportFrom, ast.alias])
+    generic_nodeclasses = unchanged_nodeclasses | {ast.Expr}  # visit_Expr lowers its value through generic_visit
+
     def __init__(self, ignored_vars) -> None:
         super().__init__()
         self.FManager = FactManager()
         self.scopeManager = ScopeManager(ignored_vars)
-        self.unchanged_nodeclasses = [ast.Global, ast.Nonlocal, ast.Pass, ast.Break, ast.Continue, ast.Import, ast.ImportFrom, ast.alias]
-
-    def visit(self, node):
-        """Visit a node."""
-        method = 'visit_' + node.__class__.__name__
-        visitor = getattr(self, method, self.generic_visit)
-        return visitor(node)
 
     def generic_visit(self, node):
         rets = ast.NodeTransformer.generic_visit(self, node)
-        if type(node) not in self.unchanged_nodeclasses + [ast.Expr]:
+        if type(node) not in self.generic_nodeclasses:
             print(type(node))
             assert False
         return rets
 
     def visit_Module(self, node):
-        phi_tree = ast.parse(phi_def_code)
-        node.body = phi_tree.body + self.visit_Body(node.body)
+        node.body = injected_defs() + self.visit_Body(node.body)
         return node
 
     def visit_Body(self, body):
         self.scopeManager.enterBlock()
         if isinstance(body, list):
-            new_values = []
-            for value in body:
-                if isinstance(value, ast.AST):   
-                    if hasattr(value, "lineno"):
-                        saved_lineno = value.lineno
-                    else:
-                        saved_lineno = -1
-                    value = self.visit(value)
-                    if value is None:
-                        continue
-                    elif not isinstance(value, ast.AST):
-                        if saved_lineno != -1:
-                            for v in value:
-                                v.lineno = saved_lineno
-                        new_values.extend(value)
-                        continue
-                new_values.append(value)
-            body[:] = new_values
+            body[:] = self.visit_Statements(body)
         self.scopeManager.leaveBlock()
         return body
 
+    def visit_Statements(self, body):
+        """Lower a list of statements in the current block."""
+        new_values = []
+        for value in body:
+            if isinstance(value, ast.AST):   
+                if hasattr(value, "lineno"):
+                    saved_lineno = value.lineno
+                else:
+                    saved_lineno = -1
+                value = self.visit(value)
+                if value is None:
+                    continue
+                elif not isinstance(value, ast.AST):
+                    if saved_lineno != -1:
+                        for v in value:
+                            v.lineno = saved_lineno
+                    new_values.extend(value)
+                    continue
+            new_values.append(value)
+        return new_values
+
     def visit_alias(self, node):
         self.scopeManager.defined_names.add(node.name)
         if node.asname:
@@ -140,7 +149,7 @@ class CodeTransformer(ast.NodeTransformer):
         ctx2 = self.scopeManager.get_tmp_new_ctx()
         node.orelse = self.visit_Body(node.orelse)
 
-        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.ctx)
+        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.frame)
         return nodes + inits + [node] + phi_calls
 
     def visit_While(self, node):
@@ -152,7 +161,7 @@ class CodeTransformer(ast.NodeTransformer):
         ctx2 = self.scopeManager.get_tmp_new_ctx()
         node.orelse = self.visit_Body(node.orelse)
 
-        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.ctx)
+        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.frame)
 
         return nodes + inits + [node] + phi_calls
 
@@ -165,7 +174,7 @@ class CodeTransformer(ast.NodeTransformer):
         ctx2 = self.scopeManager.get_tmp_new_ctx()
         node.orelse = self.visit_Body(node.orelse)
 
-        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.ctx)
+        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.frame)
 
         return nodes + inits + [node] + phi_calls
 
@@ -198,7 +207,7 @@ class CodeTransformer(ast.NodeTransformer):
         node.body = self.visit_Body(node.body)
 
         ctx2 = self.scopeManager.get_tmp_new_ctx()
-        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.ctx)
+        inits, phi_calls = self.scopeManager.resolve_upates(ctx1, ctx2, self.scopeManager.frame)
         return nodes + inits + [node] + phi_calls
 
     def visit_Delete(self, node):
@@ -242,11 +251,12 @@ class CodeTransformer(ast.NodeTransformer):
         return nodes1 + nodes2 + [ast.Assert(new_test, new_msg)]
 
     def visit_Expr(self, node):
-        node_saved = copy.deepcopy(node)
+        # the visitors build new nodes instead of rewriting the expression, so it stays intact
+        value_saved = node.value
         rets = self.generic_visit(node)
         if len(rets.value) == 2 and type(rets.value[0]) == list:
             if type(rets.value[1]) == ast.Call:
-                nodes = self.handle_call_updates(rets.value[1], node_saved.value)
+                nodes = self.handle_call_updates(rets.value[1], value_saved)
                 if nodes:
                     return rets.value[0] + nodes
             return rets.value[0] + [ast.Expr(rets.value[1])]
@@ -567,4 +577,125 @@ class CodeTransformer(ast.NodeTransformer):
         return [], node
 
     def visit_NamedExpr(self, node):
-        return [], node
\ No newline at end of file
+        return [], node
+
+def unshare(tree):
+    """Copy the nodes the lowering put in several places of tree, so that each place gets its own positions."""
+    positioned = (ast.stmt, ast.excepthandler, ast.expr)  # operators and contexts are shared singletons without positions
+    seen = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, positioned):
+                        if id(item) in seen:
+                            item = value[i] = copy.deepcopy(item)
+                        seen.add(id(item))
+                        stack.append(item)
+                    elif isinstance(item, ast.AST):
+                        stack.append(item)
+            elif isinstance(value, positioned):
+                if id(value) in seen:
+                    value = copy.deepcopy(value)
+                    setattr(node, field, value)
+                seen.add(id(value))
+                stack.append(value)
+            elif isinstance(value, ast.AST):
+                stack.append(value)
+
+
+class IRUnparser(astunparse.Unparser):
+    """Unparse the IR and give its nodes the positions they have in the output.
+
+    lineno_map maps IR lines of statements to the source lines they were lowered from,
+    so the IR never has to be parsed again. The positions are those ast.parse gives the IR,
+    columns in UTF-8 bytes, except inside f-strings: the values and format specs of a JoinedStr
+    all get the span of the whole f-string.
+    """
+    # expressions astunparse wraps in parentheses that are not theirs, as in (a + b)
+    GROUPED = tuple(getattr(ast, name) for name in ("BinOp", "Compare", "BoolOp", "UnaryOp", "IfExp", "Lambda",
+                                                    "Await", "Yield", "YieldFrom", "NamedExpr") if hasattr(ast, name))
+
+    def __init__(self, tree, file) -> None:
+        self.lineno = 1
+        self.col_offset = 0
+        self.pending = None  # statement whose line starts with the next fill
+        self.lineno_map = {}
+        unshare(tree)
+        super().__init__(tree, file)
+
+    def write(self, text):
+        super().write(text)
+        self.advance(text)
+
+    def fill(self, text=""):
+        super().fill(text)
+        self.advance("\n" + "    " * self._indent + text)
+        if self.pending is not None and not text.startswith("@"):  # decorators precede the def line
+            node, self.pending = self.pending, None
+            if getattr(node, "lineno", None) is not None:
+                self.lineno_map[str(self.lineno)] = str(node.lineno)
+            node.lineno, node.col_offset = self.lineno, 4 * self._indent
+
+    def advance(self, text):
+        newlines = text.count("\n")
+        if newlines:
+            self.lineno += newlines
+            text = text[text.rindex("\n") + 1:]
+            self.col_offset = 0
+        # ast counts columns in UTF-8 bytes
+        self.col_offset += len(text) if text.isascii() else len(text.encode("utf-8"))
+
+    def dispatch(self, tree):
+        if isinstance(tree, (ast.stmt, ast.excepthandler)):
+            self.pending = tree
+        elif isinstance(tree, ast.expr):
+            tree.lineno, tree.col_offset = self.lineno, self.col_offset
+        super().dispatch(tree)
+        if isinstance(tree, (ast.stmt, ast.excepthandler, ast.expr)):
+            tree.end_lineno, tree.end_col_offset = self.lineno, self.col_offset
+        if isinstance(tree, ast.JoinedStr):
+            # astunparse writes the f-string in one piece, its parts have no position of their own
+            for node in ast.walk(tree):
+                if isinstance(node, ast.expr):
+                    node.lineno, node.col_offset = tree.lineno, tree.col_offset
+                    node.end_lineno, node.end_col_offset = tree.end_lineno, tree.end_col_offset
+        if isinstance(tree, self.GROUPED):
+            tree.col_offset += 1
+            tree.end_col_offset -= 1
+
+    def _If(self, t):
+        # as astunparse, but nested ifs written as elif are not dispatched
+        self.fill("if ")
+        self.dispatch(t.test)
+        self.enter()
+        self.dispatch(t.body)
+        self.leave()
+        chain = []
+        while t.orelse and len(t.orelse) == 1 and isinstance(t.orelse[0], ast.If):
+            t = t.orelse[0]
+            chain.append(t)
+            self.pending = t
+            self.fill("elif ")
+            self.dispatch(t.test)
+            self.enter()
+            self.dispatch(t.body)
+            self.leave()
+        if t.orelse:
+            self.fill("else")
+            self.enter()
+            self.dispatch(t.orelse)
+            self.leave()
+        # an elif ends where the whole chain does, like the if dispatch ends
+        for t in chain:
+            t.end_lineno, t.end_col_offset = self.lineno, self.col_offset
+
+
+def unparse(tree):
+    """Return the IR code of tree and its IR to source line mapping, updating the positions in tree."""
+    v = io.StringIO()
+    unparser = IRUnparser(tree, v)
+    return v.getvalue(), unparser.lineno_map
@@ -0,0 +1,191 @@
+import time
+import uuid
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from . import procs
+from .metrics import metrics
+from .config import configs
+
+'''
+Background execution of analysis jobs, so that the Tornado IOLoop never blocks on the pipeline.
+Requests are single-flight per name: a request for the content already being analyzed attaches to
+the running job, one for new content supersedes it. A cancelled job kills its subprocesses right
+away and stops at its next stage
+'''
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, name, key=None) -> None:
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.key = key  # hash of the analyzed content, None never coalesces
+        self.status = "queued"  # queued -> running -> done / failed / cancelled
+        self.stages = []  # [{'Stage': 'ir', 'Elapsed': 0.12}, ...], the last one is the current stage
+        self.result = None
+        self.log = ""
+        self.created = time.time()
+        self.finished = None
+        self.cancelled = None  # why the job was cancelled
+        self.superseded_by = None  # id of the job that cancelled this one
+        self.clients = 1  # requests attached to the job, see JobManager.cancel
+        self.queue_position = None  # place in the node-wide queue while waiting for a slot, see scheduler.py
+        self.future = None
+        self.lock = threading.Lock()
+
+    def cancel(self, reason, superseded_by=None):
+        with self.lock:
+            if self.finished is not None or self.cancelled is not None:
+                return
+            self.cancelled = reason
+            self.superseded_by = superseded_by
+        if self.future is not None and self.future.cancel():
+            self.finish("cancelled", log=reason)
+        else:
+            # kill the stage subprocesses, the job raises JobCancelled when it enters its next stage
+            procs.kill(self.id)
+
+    def check_cancelled(self):
+        if self.cancelled is not None:
+            raise JobCancelled(self.cancelled)
+
+    def start(self):
+        with self.lock:
+            self.status = "running"
+
+    def enter_stage(self, stage):
+        now = time.time()
+        with self.lock:
+            self.check_cancelled()
+            self.queue_position = None
+            if self.stages and self.stages[-1]['Elapsed'] is None:
+                self.stages[-1]['Elapsed'] = now - self.stages[-1]['Start']
+            self.stages.append({'Stage': stage, 'Start': now, 'Elapsed': None})
+
+    def wait_for_slot(self, position):
+        with self.lock:
+            self.check_cancelled()
+            self.queue_position = position
+
+    def finish(self, status, result=None, log=""):
+        now = time.time()
+        with self.lock:
+            if self.stages and self.stages[-1]['Elapsed'] is None:
+                self.stages[-1]['Elapsed'] = now - self.stages[-1]['Start']
+            self.status = status
+            self.result = result
+            self.log = log
+            self.finished = now
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'job': self.id,
+                'name': self.name,
+                'status': self.status,
+                'stage': self.stages[-1]['Stage'] if self.stages else None,
+                'queue_position': self.queue_position,
+                'stages': [{'Stage': s['Stage'], 'Elapsed': s['Elapsed']} for s in self.stages],
+                'result': self.result,
+                'log': self.log,
+                'superseded_by': self.superseded_by,
+            }
+
+
+class JobManager(object):
+    def __init__(self, max_workers, max_finished) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="leakage-analysis")
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.inflight = {}  # name -> its queued or running job
+        self.lock = threading.Lock()
+
+    def submit(self, name, func, *args, key=None):
+        """Queue func(job, *args) on the worker pool and return the job right away.
+
+        func returns the payload exposed as job.result; exceptions mark the job as failed.
+        With a key, a job of the same name and key still in flight is returned instead,
+        and one of the same name and another key is cancelled.
+        """
+        with self.lock:
+            current = self.inflight.get(name)
+            if self.coalesce(current, key):
+                current.clients += 1
+                metrics.inc("jobs_coalesced_total", help="Requests attached to an identical job in flight")
+                return current
+            job = Job(name, key)
+            self.jobs[job.id] = job
+            self.inflight[name] = job
+            self.prune()
+            # submitted under the lock, so that cancel always finds the future of a queued job
+            job.future = self.executor.submit(self.run, job, func, *args)
+        if current is not None and current.finished is None:
+            current.cancel(f"Superseded by job {job.id}", job.id)
+            metrics.inc("jobs_superseded_total", help="Jobs cancelled by a newer version of their input")
+        return job
+
+    @staticmethod
+    def coalesce(job, key):
+        return job is not None and job.finished is None and key is not None and job.key == key and job.cancelled is None
+
+    def attach(self, name, key):
+        """The job in flight a request for name and key would be attached to, if any."""
+        with self.lock:
+            job = self.inflight.get(name)
+            return job if self.coalesce(job, key) else None
+
+    def run(self, job, func, *args):
+        job.start()
+        metrics.observe("job_queue_seconds", time.time() - job.created, help="Time jobs wait for a worker")
+        try:
+            with procs.owned_by(job.id):
+                result = func(job, *args)
+            # killed subprocesses end the pipeline with an error rather than JobCancelled
+            job.check_cancelled()
+        except JobCancelled as e:
+            job.finish("cancelled", log=str(e))
+            metrics.inc("jobs_total", help="Finished jobs by status", status="cancelled")
+            return
+        except Exception as e:
+            print(traceback.format_exc())
+            job.finish("failed", log=str(e))
+            metrics.inc("jobs_total", help="Finished jobs by status", status="failed")
+            return
+        finally:
+            self.leave(job)
+        job.finish("done", result=result)
+        metrics.inc("jobs_total", help="Finished jobs by status", status="done")
+
+    def leave(self, job):
+        with self.lock:
+            if self.inflight.get(job.name) is job:
+                del self.inflight[job.name]
+
+    def cancel(self, job_id, reason="Cancelled by the client"):
+        """Detach a client from the job, which is cancelled once no client is left."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job.clients -= 1
+            if job.clients > 0:
+                return job
+        job.cancel(reason)
+        metrics.inc("jobs_cancelled_total", help="Jobs cancelled by their clients")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def prune(self):
+        # forget the oldest finished jobs, never the ones still queued or running
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+
+job_manager = JobManager(configs.max_workers, configs.max_finished_jobs)
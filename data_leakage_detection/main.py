@@ -1,6 +1,5 @@
 import os, sys
 import ast
-import astunparse
 import json
 import shutil
 import argparse
@@ -9,8 +8,16 @@ import time
 import traceback
 from .global_collector import GlobalCollector
 from . import factgen
-from .irgen import CodeTransformer
-from .render import to_html
+from . import inference
+from . import datalog
+from .datalog import souffle_command, input_relations
+from .cache import result_cache
+from .artifacts import artifact_store, list_files
+from .scheduler import scheduler
+from . import procs
+from .irgen import CodeTransformer, unparse
+from .incremental import cell_cache
+from .metrics import metrics, observe_stage, stage_failed, observe_files
 from .config import configs
 
 def remove_files(folder):
@@ -47,84 +54,118 @@ def load_input(input_path):
     return tree
 
 @time_decorator
-def ir_transform(tree, ir_path):
+def ir_transform(tree, ir_path, input_path, name):
     ignored_vars = GlobalCollector().visit(tree)
-    v = CodeTransformer(ignored_vars)
-    new_tree = v.visit(tree)
-    new_code = astunparse.unparse(new_tree)
+    new_tree = None
+    if configs.incremental:
+        # notebook scripts only lower the cells that changed since their last analysis
+        with open(input_path) as f:
+            lines = f.read().splitlines()
+        new_tree = cell_cache.transform(name, tree, lines, ignored_vars)
+    if new_tree is None:
+        v = CodeTransformer(ignored_vars)
+        new_tree = v.visit(tree)
+    # positions of new_tree become those of the written IR, as if it was parsed again
+    new_code, lineno_map = unparse(new_tree)
     # print(new_code)
     with open(ir_path, "w") as f:
         f.write(new_code)
-    return new_tree
+    return new_tree, lineno_map
 
 @time_decorator
-def infer_types(ir_path):
+def infer_types(ir_path, json_path, precision=inference.FULL_PRECISION):
     # Call type inference engine here
-    os.system(f"timeout 5m node {configs.inference_path} {ir_path} --lib")
+    if precision == inference.FULL_PRECISION:
+        completed = inference.infer(ir_path, json_path)
+        # over budget, a one-shot run at the same precision would only spend it again before adaptive steps down
+        if completed is not None and (completed.ok or completed.over_budget):
+            return completed
+    # no warm server available, run pyright once
+    return procs.run(["node", configs.inference_path, ir_path] + inference.PRECISION_LEVELS[precision],
+                     configs.inference_timeout, cpu_seconds=configs.inference_cpu_seconds,
+                     memory_bytes=configs.inference_memory_bytes)
 
-def generate_lineno_mapping(tree1, tree2):
+@time_decorator
+def generate_facts(tree, json_path, fact_path):
+    if configs.fact_streaming:
+        fact_manager = factgen.StreamingFactManager(fact_path, configs.fact_buffer_bytes)
+    else:
+        fact_manager = factgen.FactManager()
+    try:
+        f = factgen.FactGenerator(json_path, fact_manager)
+        f.visit(tree)
+        fact_manager.write_facts(fact_path)
+    finally:
+        fact_manager.close()
+
+@time_decorator
+def datalog_analysis(fact_path, precision=datalog.FULL_PRECISION):
+    return procs.run(souffle_command(fact_path, precision), configs.datalog_timeout,
+                     cpu_seconds=configs.datalog_cpu_seconds, memory_bytes=configs.datalog_memory_bytes)
+
+def adaptive(stage, levels, run, waiting):
+    """
+    run(level) for the precision levels of a stage, from the most precise, until one stays within
+    the budgets; return the (Completed, elapsed seconds) of the last run and its level.
+    """
+    for level in levels:
+        with scheduler.slot(stage, waiting):
+            completed, elapsed = run(level)
+        if completed is None or not completed.over_budget or not configs.adaptive_precision:
+            break
+        print(f"{stage} over budget at precision {level}: " + completed.diagnostics())
+        metrics.inc("precision_fallbacks_total", help="Stages rerun at a lower precision after exceeding their budget",
+                    stage=stage, level=level)
+    return (completed, elapsed), level
+
+def failure(message, completed):
+    # what went wrong in the subprocess of the stage, for the log of the job
+    return message if completed is None else message + ": " + completed.diagnostics()
+
+def read_lineno_mapping(lineno_path):
     lineno_map = {}
-    if len(tree1.body) != len(tree2.body):
-        return lineno_map
-    def add_to_mapping(body1, body2):
-        for stmt1, stmt2 in zip(body1, body2):
-            if hasattr(stmt1, 'lineno') and hasattr(stmt2, 'lineno'):
-                lineno_map[str(stmt2.lineno)] = str(stmt1.lineno)
-            if hasattr(stmt1, 'body') and hasattr(stmt2, 'body'):
-                add_to_mapping(stmt1.body, stmt2.body)
-            if hasattr(stmt1, 'orelse') and hasattr(stmt2, 'orelse'):
-                add_to_mapping(stmt1.orelse, stmt2.orelse)
-            if hasattr(stmt1, 'handlers') and hasattr(stmt2, 'handlers'):
-                add_to_mapping(stmt1.orelse, stmt2.orelse)
-            if hasattr(stmt1, 'finalbody') and hasattr(stmt2, 'finalbody'):
-                add_to_mapping(stmt1.orelse, stmt2.orelse)
-                
-    add_to_mapping(tree1.body, tree2.body)
+    with open(lineno_path) as f:
+        for line in f.read().splitlines():
+            a, b = line.split("\t")
+            lineno_map[a] = b
     return lineno_map
 
-@time_decorator
-def generate_facts(tree, json_path, fact_path):
-    f = factgen.FactGenerator(json_path)
-    f.visit(tree)
+def main(input_path, progress=None, work_dir=None, name=None, waiting=None, precision=None):
+    """
+    Analyze the script at input_path. Intermediate files go to work_dir, by default the directory of
+    the script; name identifies the source across analyses (the notebook path), by default input_path.
+    waiting(position) is told the place of a heavy stage in the node-wide queue, see scheduler.py;
+    precision(stage, level) is told the level of the pyright and souffle stages that ran below full
+    precision, whose results are not cached.
+    """
+    if work_dir is None:
+        work_dir = os.path.dirname(input_path)
+    base_path = os.path.join(work_dir, os.path.basename(input_path))
+    ir_path = base_path + ".ir.py"
+    json_path = base_path + ".json"
+    fact_path = base_path[:-3] + "-fact"
+    html_path = base_path[:-3] + ".html"
+    lineno_path = os.path.join(fact_path, "LinenoMapping.facts")
+    t = [0]*6
 
-    for fact_name, fact_list in f.FManager.datalog_facts.items():
-        with open(os.path.join(fact_path, fact_name + ".facts"), "w") as f:
-            facts = ["\t".join(t) for t in fact_list]
-            f.writelines("\n".join(facts))
+    def enter_stage(stage):
+        if progress:
+            progress(stage)
 
-@time_decorator
-def datalog_analysis(fact_path):
-    ret = os.system(f"timeout 5m souffle {os.path.dirname(__file__)}/main.dl -F {fact_path} -D {fact_path}")
-    if ret != 0:
-        raise TimeoutError
-
-def main(input_path):
-    ir_path = input_path +".ir.py"
-    json_path = input_path + ".json"
-    fact_path = input_path[:-3] + "-fact"
-    html_path = input_path[:-3] + ".html"
-    t = [None]*6
-
-    tree, t[0] = load_input(input_path)
-    if t[0] == -1:
-        print("Failed to parse: " + input_path)
-        return "Failed to parse"
-    
-    tree, t[1] = ir_transform(tree, ir_path)
-    if t[1]== -1:
-        print("Failed to generate IR: " + input_path)
-        return "Failed to generate IR"
-    
-    _, t[2] = infer_types(ir_path)
-    if not os.path.exists(json_path):
-        print("Failed to infer types: " + input_path)
-        return "Failed to infer types" 
+    degraded = False
+    def degrade(stage, level):
+        nonlocal degraded
+        degraded = True
+        if precision:
+            precision(stage, level)
 
-    
-    newtree, t[3] = load_input(ir_path)
-    if t[3] == -1:
-        print("Failed to parse transformed file: " + input_path)
-        return "Failed to parse transformed file"
+    cache_key = None
+    if configs.result_cache and configs.output_flag:
+        with open(input_path, "rb") as f:
+            cache_key = result_cache.key(f.read())
+        result = result_cache.get(cache_key)
+        if result is not None:
+            return result
 
     # clean facts
     if not os.path.exists(fact_path):
@@ -132,31 +173,110 @@ def main(input_path):
     else:
         remove_files(fact_path)
 
-    if configs.output_flag:
-        lineno_map = generate_lineno_mapping(tree, newtree)
-        with open(os.path.join(fact_path, "LinenoMapping.facts"), "w") as f:
+    # stage outputs are reused from the artifact store when their inputs and code are unchanged
+    ir_names = {os.path.basename(ir_path): "ir.py", os.path.relpath(lineno_path, work_dir): "LinenoMapping.facts"}
+    types_names = {os.path.basename(json_path): "types.json"}
+    def stored_as(names):
+        return {b: a for a, b in names.items()}
+
+    newtree, lineno_map = None, None
+    ir_key = artifact_store.key("ir", [("source", input_path)]) if configs.artifact_store else None
+    if not ir_key or not artifact_store.fetch("ir", ir_key, work_dir, stored_as(ir_names)):
+        enter_stage("parse")
+        tree, t[0] = load_input(input_path)
+        observe_stage("parse", t[0])
+        if t[0] == -1:
+            print("Failed to parse: " + input_path)
+            return "Failed to parse"
+
+        enter_stage("ir")
+        ret, t[1] = ir_transform(tree, ir_path, input_path, name or input_path)
+        observe_stage("ir", t[1])
+        if t[1]== -1:
+            print("Failed to generate IR: " + input_path)
+            return "Failed to generate IR"
+        newtree, lineno_map = ret
+
+        with open(lineno_path, "w") as f:
             facts = [a + "\t" + b for a, b in lineno_map.items()]
             f.writelines("\n".join(facts))
-    
-    _, t[4] = generate_facts(newtree, json_path, fact_path)
-    if t[4] == -1:
-        print("Failed to generate facts: " + input_path)
-        return "Failed to generate facts" 
-    
-    _, t[5] = datalog_analysis(fact_path)
-    if t[5] == -1:
-        print("Failed to analyze: " + input_path)
-        return "Failed to analyze" 
+        if ir_key:
+            artifact_store.store("ir", ir_key, work_dir, list(ir_names), ir_names)
+    if lineno_map is None:
+        lineno_map = read_lineno_mapping(lineno_path)
+
+    types_key = artifact_store.key("types", [("ir", ir_path)]) if configs.artifact_store else None
+    if not types_key or not artifact_store.fetch("types", types_key, work_dir, stored_as(types_names)):
+        enter_stage("inference")
+        (completed, t[2]), level = adaptive("inference", inference.PRECISION_LEVELS,
+                                            lambda level: infer_types(ir_path, json_path, level), waiting)
+        observe_stage("inference", t[2] if os.path.exists(json_path) else -1)
+        if not os.path.exists(json_path):
+            print("Failed to infer types: " + input_path)
+            return failure("Failed to infer types", completed)
+        if level != inference.FULL_PRECISION:
+            degrade("inference", level)
+        elif types_key:
+            artifact_store.store("types", types_key, work_dir, list(types_names), types_names)
+
+    facts_key = artifact_store.key("facts", [("ir", ir_path), ("types", json_path)]) if configs.artifact_store else None
+    if not facts_key or not artifact_store.fetch("facts", facts_key, fact_path):
+        if newtree is None:  # the IR came from the artifact store
+            enter_stage("reparse")
+            newtree, t[3] = load_input(ir_path)
+            observe_stage("reparse", t[3])
+            if t[3] == -1:
+                print("Failed to parse transformed file: " + input_path)
+                return "Failed to parse transformed file"
 
+        enter_stage("facts")
+        _, t[4] = generate_facts(newtree, json_path, fact_path)
+        observe_stage("facts", t[4])
+        if t[4] == -1:
+            print("Failed to generate facts: " + input_path)
+            return "Failed to generate facts" 
+        if facts_key:
+            artifact_store.store("facts", facts_key, fact_path, list_files(fact_path, ".facts", ["LinenoMapping.facts"]))
+
+    datalog_key = None
+    if configs.artifact_store:
+        # only relations souffle reads, edits that merely move lines keep the outputs
+        fact_files = [name + ".facts" for name in input_relations() if os.path.exists(os.path.join(fact_path, name + ".facts"))]
+        datalog_key = artifact_store.key("datalog", [(name, os.path.join(fact_path, name)) for name in fact_files])
+    if not datalog_key or not artifact_store.fetch("datalog", datalog_key, fact_path):
+        enter_stage("datalog")
+        (completed, t[5]), level = adaptive("datalog", datalog.PRECISION_LEVELS,
+                                            lambda level: datalog_analysis(fact_path, level), waiting)
+        if completed is not None and not completed.ok:
+            t[5] = -1
+        observe_stage("datalog", t[5])
+        if t[5] == -1:
+            print("Failed to analyze: " + input_path)
+            return failure("Failed to analyze", completed)
+        if level != datalog.FULL_PRECISION:
+            degrade("datalog", level)
+        elif datalog_key:
+            artifact_store.store("datalog", datalog_key, fact_path, list_files(fact_path, ".csv"))
+    observe_files("fact", fact_path, ".facts")
+    observe_files("output", fact_path, ".csv")
+
+    result = t  # per-stage timings when no report is rendered, as run.py expects
     if configs.output_flag:
+        enter_stage("render")
         print("Converting notebooks to html...")
         try:
+            from .render import to_html  # pandas and pygments, only needed for reports
+            st = time.time()
             result = to_html(input_path, fact_path, html_path, lineno_map)
+            observe_stage("render", time.time() - st)
         except:
             print("Conversion failed!")
+            stage_failed("render")
             return "Failed to convert"
     
     print("Success!\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}\t".format(t[0]+t[1]+t[3]+t[4], t[2], t[5], sum(t)))
+    if cache_key and not degraded:
+        result_cache.put(cache_key, result)
     # delete files
     os.remove(ir_path)
     os.remove(json_path)
@@ -0,0 +1,123 @@
+import os
+import threading
+from collections import OrderedDict
+
+'''
+In-process metrics of the analysis pipeline, exposed as JSON or Prometheus text by MetricsHandler
+'''
+PREFIX = "data_leakage_detection_"
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (1 << 10, 1 << 13, 1 << 16, 1 << 19, 1 << 22, 1 << 25, 1 << 28)
+
+class Histogram(object):
+    def __init__(self, buckets) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        les = [str(b) for b in self.buckets] + ["+Inf"]
+        total = 0
+        for le, n in zip(les, self.counts):
+            total += n
+            yield le, total
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self.histograms = OrderedDict()  # name -> {labels: Histogram}
+        self.counters = OrderedDict()  # name -> {labels: value}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, help="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+            self.help.setdefault(name, help)
+
+    def inc(self, name, value=1, help="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self.help.setdefault(name, help)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'histograms': {name: [{'labels': dict(key), 'buckets': dict(h.cumulative()), 'sum': h.sum, 'count': h.count}
+                                      for key, h in series.items()] for name, series in self.histograms.items()},
+                'counters': {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                             for name, series in self.counters.items()},
+            }
+
+    def to_prometheus(self):
+        def fmt(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+        lines = []
+        with self.lock:
+            for name, series in self.histograms.items():
+                lines.append(f"# HELP {PREFIX}{name} {self.help[name]}")
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, h in series.items():
+                    for le, n in h.cumulative():
+                        lines.append(f"{PREFIX}{name}_bucket{fmt(key, [('le', le)])} {n}")
+                    lines.append(f"{PREFIX}{name}_sum{fmt(key)} {h.sum}")
+                    lines.append(f"{PREFIX}{name}_count{fmt(key)} {h.count}")
+            for name, series in self.counters.items():
+                lines.append(f"# HELP {PREFIX}{name} {self.help[name]}")
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for key, value in series.items():
+                    lines.append(f"{PREFIX}{name}{fmt(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+
+
+def observe_stage(stage, elapsed):
+    """Record a pipeline stage, elapsed is -1 when it failed as in main.time_decorator."""
+    if elapsed == -1:
+        stage_failed(stage)
+    else:
+        metrics.observe("stage_seconds", elapsed, help="Latency of pipeline stages", stage=stage)
+
+def stage_failed(stage):
+    metrics.inc("stage_failures_total", help="Failed pipeline stages", stage=stage)
+
+def cache_lookup(cache, hit, stage=None):
+    labels = {'cache': cache, 'result': "hit" if hit else "miss"}
+    if stage:
+        labels['stage'] = stage
+    metrics.inc("cache_lookups_total", help="Cache lookups by cache and outcome", **labels)
+
+def observe_files(kind, folder, suffix):
+    """Record the size of fact (input) or csv (output) relations of one analysis."""
+    total_bytes = 0
+    total_tuples = 0
+    for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+        if not entry.name.endswith(suffix):
+            continue
+        total_bytes += entry.stat().st_size
+        with open(entry.path, "rb") as f:
+            tuples = sum(1 for line in f if line.strip())
+        total_tuples += tuples
+        metrics.inc(f"{kind}_tuples_total", tuples, help=f"Tuples of {kind} relations", relation=entry.name[:-len(suffix)])
+    metrics.observe(f"{kind}_bytes", total_bytes, SIZE_BUCKETS, help=f"Size of the {kind} relations of an analysis")
+    metrics.observe(f"{kind}_tuples", total_tuples, SIZE_BUCKETS, help=f"Tuples in the {kind} relations of an analysis")
@@ -0,0 +1,82 @@
+from bisect import bisect_right
+
+'''
+In-process replacement of `jupyter nbconvert --to script`: the script keeps the layout nbconvert writes
+("# In[ ]:" headers followed by two blank lines, see incremental.split_cells), and the table of where
+each code cell starts maps script lines back to notebook cells
+'''
+_transformer = None
+
+def transformer():
+    # IPython and prompt_toolkit take hundreds of ms to import, the server only pays for them on the first conversion
+    global _transformer
+    if _transformer is None:
+        try:
+            from IPython.core.inputtransformer2 import TransformerManager
+            _transformer = TransformerManager()
+        except ImportError:
+            _transformer = False
+    return _transformer
+
+def python_source(source):
+    """Cell source with IPython syntax (magics, shell escapes, help) turned into python, as nbconvert does."""
+    if transformer():
+        return transformer().transform_cell(source).rstrip("\n")
+    # without IPython, keep the lines but comment the ones python cannot parse
+    lines = source.split("\n")
+    for i, line in enumerate(lines):
+        stripped = line.lstrip()
+        if stripped[:1] in ("%", "!") or stripped.endswith("?"):
+            lines[i] = line[:len(line) - len(stripped)] + "# " + stripped
+    return "\n".join(lines)
+
+
+class CellMap(object):
+    def __init__(self) -> None:
+        self.starts = []  # 1-indexed script line of the first line of every code cell
+        self.cells = []  # index of that cell in the notebook, markdown and raw cells included
+
+    def add(self, start, cell):
+        self.starts.append(start)
+        self.cells.append(cell)
+
+    def locate(self, lineno):
+        """Notebook cell and 0-indexed line in it of a 1-indexed script line."""
+        i = max(bisect_right(self.starts, lineno) - 1, 0)
+        return self.cells[i], lineno - self.starts[i]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def notebook_to_script(nb):
+    """The script of the code cells of a v4 notebook, and its CellMap."""
+    out = ["#!/usr/bin/env python", "# coding: utf-8", ""]
+    cell_map = CellMap()
+    for i, cell in enumerate(nb["cells"]):
+        if cell["cell_type"] != "code":
+            continue
+        count = cell.get("execution_count")
+        out += ["# In[{}]:".format(count if count else " "), "", ""]
+        cell_map.add(len(out) + 1, i)
+        out += python_source(cell["source"]).split("\n")
+        out += ["", ""]
+    return "\n".join(out) + "\n", cell_map
+
+def write_script(nb, script_path):
+    """Write the script of the notebook to script_path, return its CellMap."""
+    script, cell_map = notebook_to_script(nb)
+    with open(script_path, "w") as f:
+        f.write(script)
+    return cell_map
+
+def convert(ipynb_path, script_path):
+    # nbformat pulls in jsonschema, only .ipynb files on disk need it
+    import nbformat
+    return write_script(nbformat.read(ipynb_path, as_version=4), script_path)
+
+def valid_cells(cells):
+    """Whether cells sent by the frontend look like [{"cell_type": ..., "source": ...}]."""
+    return isinstance(cells, list) and all(
+        isinstance(cell, dict) and isinstance(cell.get("cell_type"), str) and isinstance(cell.get("source"), str)
+        for cell in cells)
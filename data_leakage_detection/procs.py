@@ -0,0 +1,207 @@
+import os
+import time
+import signal
+import asyncio
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # no rlimits, only deadlines
+    resource = None
+
+'''
+Subprocesses of the pipeline stages (one-shot pyright, souffle), run by one asyncio loop in the
+background. Every process leads a session of its own, with a deadline, and the tail of its output is
+kept for diagnostics. Processes belong to the job running on the calling thread: cancelling the job
+kills their whole process groups at once, node and souffle workers included. CPU and memory budgets
+are rlimits, set on the process as soon as it starts
+'''
+TAIL_BYTES = 16 << 10  # output kept per stream
+# how a process over its rlimits usually ends: SIGXCPU then SIGKILL for CPU, failed allocations for memory
+BUDGET_SIGNALS = (-signal.SIGXCPU, -signal.SIGKILL, -signal.SIGABRT, -signal.SIGSEGV)
+OUT_OF_MEMORY = ("bad_alloc", "out of memory", "Cannot allocate memory")
+
+_loop = None
+_loop_lock = threading.Lock()
+_local = threading.local()
+_running = {}  # owner -> {Process}
+_cancelled = set()  # owners whose processes must not run
+_lock = threading.Lock()
+
+
+class Completed(object):
+    def __init__(self, args, returncode, stdout, stderr, elapsed, timed_out=False, cancelled=False, limited=False) -> None:
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout  # tails, decoded
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.limited = limited  # ran under rlimits
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    @property
+    def over_budget(self):
+        """Whether the process ran out of time, CPU or memory, rather than failed on its own."""
+        if self.cancelled or self.returncode == 0:
+            return False
+        if self.timed_out:
+            return True
+        return self.limited and (self.returncode in BUDGET_SIGNALS or any(m in self.stderr for m in OUT_OF_MEMORY))
+
+    def diagnostics(self):
+        """One line on how the process ended, followed by the end of its stderr (stdout when stderr is empty)."""
+        if self.cancelled:
+            status = "cancelled"
+        elif self.timed_out:
+            status = "timed out after {:.0f}s".format(self.elapsed)
+        elif self.returncode is None:
+            status = "could not start"
+        elif self.returncode < 0:
+            status = "killed by signal {}".format(-self.returncode)
+        else:
+            status = "exited with status {}".format(self.returncode)
+        output = (self.stderr or self.stdout).strip()
+        return "{} {}".format(os.path.basename(self.args[0]), status) + ("\n" + output if output else "")
+
+
+def loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="procs", daemon=True).start()
+    return _loop
+
+@contextmanager
+def owned_by(owner):
+    """Processes started by this thread in the body belong to owner, see kill."""
+    _local.owner = owner
+    try:
+        yield
+    finally:
+        _local.owner = None
+        with _lock:
+            _cancelled.discard(owner)
+
+def current_owner():
+    return getattr(_local, "owner", None)
+
+def cancelled():
+    """Whether the owner of this thread was killed, for waits that do not go through run."""
+    owner = current_owner()
+    with _lock:
+        return owner is not None and owner in _cancelled
+
+def killpg(proc):
+    if proc.returncode is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:  # already gone
+            pass
+
+def kill(owner):
+    """Kill the processes of owner, and refuse to start new ones until it leaves owned_by; safe from any thread."""
+    with _lock:
+        _cancelled.add(owner)
+        procs = list(_running.get(owner, ()))
+    for proc in procs:
+        killpg(proc)
+
+def kill_all():
+    with _lock:
+        procs = [proc for group in _running.values() for proc in group]
+    for proc in procs:
+        killpg(proc)
+
+async def read_tail(stream):
+    tail = bytearray()
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            return tail.decode(errors="replace")
+        tail += chunk
+        del tail[:-TAIL_BYTES]
+
+def set_limits(pid, cpu_seconds, memory_bytes):
+    """Apply the budgets to a running process, return whether any could be set."""
+    if resource is None or not hasattr(resource, "prlimit"):
+        return False
+    limits = []
+    if cpu_seconds:
+        # SIGXCPU at the soft limit, SIGKILL a second later if it is ignored
+        limits.append((resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1)))
+    if memory_bytes:
+        # heap and private mappings: address space limits break runtimes that reserve a lot of it, like V8
+        limits.append((resource.RLIMIT_DATA, (memory_bytes, memory_bytes)))
+    try:
+        for limit, value in limits:
+            resource.prlimit(pid, limit, value)
+    except OSError:  # already gone
+        pass
+    return bool(limits)
+
+def cpu_time(pid):
+    """CPU seconds used so far by a running process, None where /proc cannot tell."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime and stime
+    except (OSError, IndexError, ValueError):
+        return None
+
+def rss(pid):
+    """Resident memory of a running process in bytes, None where /proc cannot tell."""
+    try:
+        with open("/proc/{}/statm".format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+async def execute(args, timeout, owner, cwd, cpu_seconds, memory_bytes):
+    st = time.monotonic()
+    try:
+        proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                    cwd=cwd, start_new_session=True)
+    except OSError as e:  # e.g. node or souffle is missing
+        return Completed(args, None, "", str(e), time.monotonic() - st)
+    # the exec is done, the budgets only miss what ran before it
+    limited = set_limits(proc.pid, cpu_seconds, memory_bytes)
+    with _lock:
+        group = _running.setdefault(owner, set())
+        group.add(proc)
+        killed = owner in _cancelled
+    if killed:  # cancelled while it was starting
+        killpg(proc)
+    readers = asyncio.gather(read_tail(proc.stdout), read_tail(proc.stderr))
+    timed_out = False
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        killpg(proc)
+        await proc.wait()
+    finally:
+        with _lock:
+            group.discard(proc)
+            if not group and _running.get(owner) is group:
+                del _running[owner]
+            killed = owner in _cancelled
+    stdout, stderr = await readers
+    return Completed(args, proc.returncode, stdout, stderr, time.monotonic() - st, timed_out, killed, limited)
+
+def run(args, timeout=None, cwd=None, cpu_seconds=None, memory_bytes=None):
+    """
+    Run args to completion or until timeout seconds, return a Completed; blocks the calling thread only.
+    cpu_seconds and memory_bytes are rlimits of the process, None for no limit.
+    """
+    owner = current_owner()
+    with _lock:
+        if owner is not None and owner in _cancelled:
+            return Completed(args, None, "", "", 0, cancelled=True)
+    return asyncio.run_coroutine_threadsafe(execute(args, timeout, owner, cwd, cpu_seconds, memory_bytes), loop()).result()
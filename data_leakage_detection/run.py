@@ -1,7 +1,28 @@
 import os, sys
+import time
+import queue
+import shutil
+import signal
+import tempfile
 import subprocess
 import argparse
+import multiprocessing
 from .main import main
+from .config import configs
+from .datalog import OUTPUT_PROFILES, PRECISION_LEVELS, FULL_PRECISION, compile_ahead
+from . import workspace
+from . import procs
+
+def souffle_jobs(value):
+    if value == "auto":
+        return value
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError('expected "auto" or a positive number of threads, got ' + repr(value))
+    return jobs
 
 parser = argparse.ArgumentParser(description='Run analysis in batch')
 parser.add_argument('dir', help='the directory of python files to be analyzed')
@@ -9,6 +30,14 @@ parser.add_argument('-s', '--sort', help='sort python files by number', action="
 parser.add_argument('-r', '--recursive', help='search for python files recursively', action="store_true")
 parser.add_argument('-f', '--file', help='analyze file dir', action="store")
 parser.add_argument('-o', '--output-flag', help='output html file', action="store_true")
+parser.add_argument('--souffle-jobs', help='souffle threads per analysis, or "auto" to size them from the facts',
+                    type=souffle_jobs, default="auto")
+parser.add_argument('--output-profile', help='relations souffle writes: only those the report reads, or all of them for debugging',
+                    choices=list(OUTPUT_PROFILES), default=configs.output_profile)
+parser.add_argument('-j', '--jobs', help='analyze N files in parallel, each in its own process and scratch directory', type=int, default=0)
+parser.add_argument('-t', '--timeout', help='wall-clock budget per file in seconds, with --jobs', type=float, default=600)
+parser.add_argument('--resume', help='skip files already logged as successful', action="store_true")
+parser.add_argument('--scratch-dir', help='where parallel analyses copy their file, with --jobs', default=workspace.scratch_root())
 args = parser.parse_args()
 
 def print_red(msg):
@@ -16,21 +45,143 @@ def print_red(msg):
 
 def write_to_log(filename, msg=""):
     log.write(filename + "\t" + msg + "\n")
+    log.flush()  # keep the log complete for --resume
 
-def analyze(file, file_path):
+def logged_successes(log_path):
+    done = set()
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) > 1 and fields[1].startswith("Success"):
+                    done.add(fields[0])
+    return done
+
+def run_analysis(file_path, waiting=None):
+    """Analyze file_path, return the messages to log for it; waiting is passed on to main."""
+    msgs = []
     result = subprocess.run(["2to3", "-w", file_path]) 
     if result.returncode:
         print_red("Conversion failed!")
-        write_to_log(file, "Conversion failed")
+        msgs.append("Conversion failed")
     
-    msg = main(file_path)
+    msg = main(file_path, waiting=waiting)
     if type(msg) == str:
         print_red("Analysis failed!")
-        write_to_log(file, msg)
+        msgs.append(msg)
     else:
-        write_to_log(file, "Success!\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}\t".format(msg[0]+msg[1]+msg[3]+msg[4], msg[2], msg[5], sum(msg)))
+        msgs.append("Success!\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}\t".format(msg[0]+msg[1]+msg[3]+msg[4], msg[2], msg[5], sum(msg)))
+    return msgs
+
+def analyze(file, file_path):
+    for msg in run_analysis(file_path):
+        write_to_log(file, msg)
+
+def terminate(signum, frame):
+    # pyright and souffle lead sessions of their own, see procs.py
+    procs.kill_all()
+    os._exit(1)
+
+def analyze_isolated(file, file_path, scratch_dir, results):
+    # own session, so that a timeout also kills what runs under it
+    os.setsid()
+    signal.signal(signal.SIGTERM, terminate)
+    # a single analysis per process, a warm pyright server would not be reused
+    configs.inference_server = False
+    # nor would a souffle binary built here, the parent compiled it ahead
+    configs.souffle_background_compile = False
+    queued = False
+    def waiting(position):
+        # the parent stops the clock of the file while it waits for a node-wide slot, see scheduler.py
+        nonlocal queued
+        if (position is not None) != queued:
+            queued = position is not None
+            results.put(("queued" if queued else "served", file, None))
+    try:
+        scratch_path = os.path.join(scratch_dir, os.path.basename(file_path))
+        shutil.copyfile(file_path, scratch_path)
+        msgs = run_analysis(scratch_path, waiting)
+    except Exception as e:
+        msgs = ["Failed: " + str(e)]
+    results.put(("done", file, msgs))
+
+def kill_session(proc):
+    # the analysis kills its stage subprocesses on SIGTERM, the rest of its session is killed below
+    try:
+        os.kill(proc.pid, signal.SIGTERM)
+        proc.join(1)
+    except OSError:
+        pass
+    pids = [proc.pid]
+    if os.path.isdir("/proc"):
+        for pid in os.listdir("/proc"):
+            try:
+                if pid.isdigit() and os.getsid(int(pid)) == proc.pid:
+                    pids.append(int(pid))
+            except OSError:
+                continue
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            continue
+    proc.join()
+
+def analyze_parallel(tasks, jobs, timeout, scratch_root):
+    """
+    Analyze (file, file_path) tasks in at most jobs processes, killing those over the time budget.
+    Time spent queued for a node-wide slot does not count, other servers may hold them all.
+    """
+    results = multiprocessing.Queue()
+    pending = list(tasks)
+    running = {}  # file -> [process, scratch dir, deadline, queued since or None]
+    finished = {}  # file -> messages
+    while pending or running:
+        while pending and len(running) < jobs:
+            file, file_path = pending.pop(0)
+            scratch_dir = tempfile.mkdtemp(prefix="run-", dir=scratch_root)
+            proc = multiprocessing.Process(target=analyze_isolated, args=(file, file_path, scratch_dir, results))
+            proc.start()
+            running[file] = [proc, scratch_dir, time.monotonic() + timeout, None]
+        events = []
+        try:
+            events.append(results.get(timeout=0.5))
+            while True:
+                events.append(results.get_nowait())
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        for event, file, msgs in events:
+            if event == "done":
+                finished[file] = msgs
+            elif file not in running:
+                continue
+            elif event == "queued":
+                running[file][3] = now
+            elif running[file][3] is not None:  # served
+                running[file][2] += now - running[file][3]
+                running[file][3] = None
+        for file, (proc, scratch_dir, deadline, queued_since) in list(running.items()):
+            if file in finished:
+                proc.join()
+                msgs = finished.pop(file)
+            elif proc.is_alive() and queued_since is None and now > deadline:
+                kill_session(proc)
+                print_red("Analysis timed out!")
+                msgs = ["Timeout"]
+            elif not proc.is_alive() and proc.exitcode != 0:
+                print_red("Analysis crashed!")
+                msgs = ["Crashed"]
+            else:  # still running, or its result is on the way
+                continue
+            for msg in msgs:
+                write_to_log(file, msg)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            del running[file]
 
 if __name__ == "__main__":
+    configs.souffle_jobs = args.souffle_jobs
+    configs.output_profile = args.output_profile
     if args.file:
         with open(args.file) as f:
             files = f.read().splitlines()
@@ -49,9 +200,18 @@ if __name__ == "__main__":
         sorted_files = sorted(files, key=lambda x: int(x.split('_')[1].split('.')[0]))
     else:
         sorted_files = files
-    for file in sorted_files:
-        file_path  = os.path.join("..", "GitHubAPI-Crawler", file) if args.file else os.path.join(dir_path, file) 
-        analyze(file, file_path)
+    if args.resume:
+        done = logged_successes(log_path)
+        sorted_files = [file for file in sorted_files if file not in done]
+    if configs.souffle_compile:
+        # once for the whole batch, rather than in (and killed with) the analyses
+        compile_ahead(PRECISION_LEVELS if configs.adaptive_precision else [FULL_PRECISION])
+    tasks = [(file, os.path.join("..", "GitHubAPI-Crawler", file) if args.file else os.path.join(dir_path, file)) for file in sorted_files]
+    if args.jobs > 0:
+        analyze_parallel(tasks, args.jobs, args.timeout, args.scratch_dir)
+    else:
+        for file, file_path in tasks:
+            analyze(file, file_path)
     log.close()
 
     # main.main(test_file_path)
\ No newline at end of file
@@ -0,0 +1,192 @@
+import os
+import time
+import uuid
+import getpass
+import tempfile
+from contextlib import contextmanager
+from .metrics import metrics
+from .config import configs
+try:
+    import fcntl
+except ImportError:  # no flock, every stage runs right away
+    fcntl = None
+
+'''
+Node-wide limit on the heavy stages (pyright and souffle) shared by every Jupyter server of the
+machine, as on a JupyterHub node: a stage runs once it holds one of the slot files locked with flock.
+Waiters leave a locked ticket in the queue directory and are served round-robin across users; locks
+die with their process, so a killed server never keeps a slot or a place in the queue
+'''
+POLL_INTERVAL = 0.5  # seconds between two looks at the queue
+
+def user():
+    return os.environ.get("JUPYTERHUB_USER") or getpass.getuser()
+
+def shared_file(path):
+    # readable by the servers of other users, whatever their umask
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        os.fchmod(fd, 0o644)
+    except OSError:  # created by another user
+        pass
+    return fd
+
+def locked(path):
+    """Whether another open file holds a lock on path, None when it is gone."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+
+
+class Scheduler(object):
+    def __init__(self, root, slots) -> None:
+        self.root = root
+        self.slots = slots
+        self.queue_dir = os.path.join(root, "queue")
+        self.slot_dir = os.path.join(root, "slots")
+        self.served_dir = os.path.join(root, "served")  # one file per user, touched when one of its stages starts
+
+    def enabled(self):
+        return fcntl is not None and bool(self.slots)
+
+    def setup(self):
+        for path in (self.root, self.queue_dir, self.slot_dir, self.served_dir):
+            try:
+                os.mkdir(path)
+                os.chmod(path, 0o1777)  # shared by the servers of every user
+            except FileExistsError:
+                pass
+
+    def tickets(self):
+        """Live tickets as (state, created, owner, name), state "q" while queued and "r" while running."""
+        try:
+            names = os.listdir(self.queue_dir)
+        except FileNotFoundError:
+            return []
+        tickets = []
+        for name in names:
+            if name.startswith("."):  # not locked yet
+                continue
+            path = os.path.join(self.queue_dir, name)
+            alive = locked(path)
+            if alive is None:
+                continue
+            if not alive:  # its server died
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            state, created, _, owner = name.split("-", 3)
+            tickets.append((state, int(created), owner, name))
+        return tickets
+
+    def last_served(self, owner):
+        try:
+            return os.stat(os.path.join(self.served_dir, owner)).st_mtime_ns
+        except OSError:
+            return 0
+
+    def waiting(self):
+        """
+        Queued tickets in the order they are served: the n-th job of every user, running ones included,
+        before the (n+1)-th of any, and the users served least recently first.
+        """
+        served = {}
+        order = []
+        for state, created, owner, name in sorted(self.tickets(), key=lambda t: (t[0] != "r", t[1])):
+            served[owner] = served.get(owner, 0) + 1
+            if state == "q":
+                order.append((served[owner], self.last_served(owner), created, name))
+        return [ticket[-1] for ticket in sorted(order)]
+
+    def backlog(self):
+        """Number of queued stages; lists the queue and tries the lock of every ticket, so not on the IOLoop."""
+        return len(self.waiting()) if self.enabled() else 0
+
+    def saturated(self, backlog):
+        return self.enabled() and backlog >= configs.scheduler_max_queue
+
+    def retry_after(self, backlog):
+        """Seconds a rejected client should wait, one typical heavy stage per round of slots."""
+        rounds = backlog // self.slots + 1
+        return rounds * configs.scheduler_stage_seconds
+
+    def touch_served(self):
+        path = os.path.join(self.served_dir, user().encode().hex())
+        try:
+            with open(path, "a"):
+                pass
+            os.utime(path)
+        except OSError:
+            pass
+
+    def move(self, ticket, name):
+        path = os.path.join(self.queue_dir, name)
+        os.rename(ticket, path)
+        return path
+
+    def try_slot(self):
+        for i in range(self.slots):
+            try:
+                fd = shared_file(os.path.join(self.slot_dir, str(i)))
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    @contextmanager
+    def slot(self, stage, waiting=None):
+        """Hold a slot for the body; waiting(position) is called while queued, with None once served, and may raise to give up."""
+        if not self.enabled():
+            yield
+            return
+        self.setup()
+        st = time.time()
+        name = "{:020d}-{}-{}".format(time.time_ns(), uuid.uuid4().hex, user().encode().hex())
+        # locked before it shows up in the queue, or another waiter would take it for a dead one
+        ticket = os.path.join(self.queue_dir, "." + name)
+        ticket_fd = shared_file(ticket)
+        fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+        fd = None
+        try:
+            ticket = self.move(ticket, "q-" + name)
+            while fd is None:
+                position = self.waiting().index("q-" + name)
+                # only the head of the queue competes for free slots
+                if position < self.slots:
+                    fd = self.try_slot()
+                if fd is None:
+                    if waiting:
+                        waiting(position)
+                    time.sleep(POLL_INTERVAL)
+            # the running ticket keeps counting as a turn of its user
+            ticket = self.move(ticket, "r-" + name)
+            self.touch_served()
+            metrics.observe("scheduler_wait_seconds", time.time() - st, help="Time heavy stages wait for a node-wide slot", stage=stage)
+            if waiting:
+                waiting(None)
+            yield
+        finally:
+            os.unlink(ticket)
+            os.close(ticket_fd)
+            if fd is not None:
+                os.close(fd)  # releases the slot
+
+
+scheduler = Scheduler(configs.scheduler_dir or os.path.join(tempfile.gettempdir(), "data_leakage_detection-scheduler"),
+                      configs.scheduler_slots)
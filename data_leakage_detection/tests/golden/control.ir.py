@@ -0,0 +1,67 @@
+
+
+def __phi__(phi_0, phi_1):
+    if phi_0:
+        return phi_0
+    return phi_1
+
+def set_field_wrapper(base, attr, value):
+    setattr(base, attr, value)
+    return base
+
+def set_index_wrapper(base, attr, value):
+    setattr(base, attr, value)
+    return base
+
+def global_wrapper(x):
+    return x
+import pandas as pd
+from sklearn.feature_selection import SelectKBest
+_var0 = 'a.csv'
+df = pd.read_csv(_var0)
+total = 0
+_var1 = len(df)
+_var2 = 100
+_var3 = (_var1 > _var2)
+if _var3:
+    _var4 = 100
+    df_0 = df.sample(_var4)
+    mode = 'sampled'
+else:
+    _var5 = df.empty
+    if _var5:
+        mode_0 = 'empty'
+    else:
+        mode_1 = 'full'
+    mode_2 = __phi__(mode_0, mode_1)
+df_1 = __phi__(df_0, df)
+mode_3 = __phi__(mode, mode_2)
+_var6 = df_1.columns
+for col in _var6:
+    _var7 = df_1.mean()
+    df_2 = df_1.fillna(_var7)
+    _var8 = 1
+    total_0 = (total + _var8)
+df_3 = __phi__(df_2, df_1)
+total_1 = __phi__(total_0, total)
+_var9 = 0
+_var10 = (total_1 > _var9)
+while _var10:
+    _var11 = 1
+    total_2 = (total_1 - _var11)
+total_3 = __phi__(total_2, total_1)
+try:
+    _var12 = 3
+    sel = SelectKBest(k=_var12)
+    _var13 = 'y'
+    _var14 = df_3.pop(_var13)
+    x = sel.fit_transform(df_3, _var14)
+except ValueError as e:
+    x_0 = df_3
+finally:
+    print(mode_3, total_3)
+_var15 = 'out.txt'
+f = open(_var15)
+with open(_var15) as f:
+    _var16 = str(x)
+    f.write(_var16)
@@ -0,0 +1,26 @@
+import pandas as pd
+from sklearn.feature_selection import SelectKBest
+
+df = pd.read_csv('a.csv')
+total = 0
+if len(df) > 100:
+    df = df.sample(100)
+    mode = 'sampled'
+elif df.empty:
+    mode = 'empty'
+else:
+    mode = 'full'
+for col in df.columns:
+    df = df.fillna(df.mean())
+    total = total + 1
+while total > 0:
+    total -= 1
+try:
+    sel = SelectKBest(k=3)
+    x = sel.fit_transform(df, df.pop('y'))
+except ValueError as e:
+    x = df
+finally:
+    print(mode, total)
+with open('out.txt') as f:
+    f.write(str(x))
@@ -0,0 +1,66 @@
+
+
+def __phi__(phi_0, phi_1):
+    if phi_0:
+        return phi_0
+    return phi_1
+
+def set_field_wrapper(base, attr, value):
+    setattr(base, attr, value)
+    return base
+
+def set_index_wrapper(base, attr, value):
+    setattr(base, attr, value)
+    return base
+
+def global_wrapper(x):
+    return x
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+
+class Model(LogisticRegression):
+
+    def __init__(self, c=1.0):
+        self_0 = set_field_wrapper(self, 'c', c)
+
+    def fit_scaled(self_1, x, y):
+        _var0 = x.max()
+        x_0 = (x / _var0)
+        _var1 = self_1.fit(x_0, y)
+        return _var1
+
+def load(path, *args, sep=',', **kwargs):
+    data = pd.read_csv(path, sep=sep)
+    _var2 = data.dropna()
+    return _var2
+
+def rows(data_0):
+    _var3 = data_0.itertuples()
+    for row in _var3:
+        (yield row)
+_var4 = 'a.csv'
+df = load(_var4)
+squares = [(v * v) for v in range(10)]
+pairs = {k: str(k) for k in squares}
+
+def _func0(a):
+    _var5 = 2
+    _var6 = (a / _var5)
+    return _var6
+scale = _func0
+_var7 = 1
+_var8 = scale(_var7)
+_var9 = 2
+_var10 = scale(_var9)
+a_0 = _var8
+b = _var10
+_var11 = scale(df)
+df_0 = set_field_wrapper(df, 'scaled', _var11)
+_var12 = 0.5
+model = Model(c=_var12)
+_var13 = 'y'
+_var14 = 1
+_var15 = df_0.drop(_var13, axis=_var14)
+_var16 = 'y'
+_var17 = df_0.pop(_var16)
+model.fit_scaled(_var15, _var17)
@@ -0,0 +1,27 @@
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+
+class Model(LogisticRegression):
+    def __init__(self, c=1.0):
+        self.c = c
+
+    def fit_scaled(self, x, y):
+        x = x / x.max()
+        return self.fit(x, y)
+
+def load(path, *args, sep=',', **kwargs):
+    data = pd.read_csv(path, sep=sep)
+    return data.dropna()
+
+def rows(data):
+    for row in data.itertuples():
+        yield row
+
+df = load('a.csv')
+squares = [v * v for v in range(10)]
+pairs = {k: str(k) for k in squares}
+scale = lambda a: a / 2
+a, b = scale(1), scale(2)
+df.scaled = scale(df)
+model = Model(c=0.5)
+model.fit_scaled(df.drop('y', axis=1), df.pop('y'))
@@ -0,0 +1,41 @@
+
+
+def __phi__(phi_0, phi_1):
+    if phi_0:
+        return phi_0
+    return phi_1
+
+def set_field_wrapper(base, attr, value):
+    setattr(base, attr, value)
+    return base
+
+def set_index_wrapper(base, attr, value):
+    setattr(base, attr, value)
+    return base
+
+def global_wrapper(x):
+    return x
+import pandas as pd
+import numpy as np
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+_var0 = 'train.csv'
+df = pd.read_csv(_var0)
+_var1 = 'label'
+y = df.pop(_var1)
+_var2 = 'id'
+_var3 = 1
+_var4 = df.drop(_var2, axis=_var3)
+_var5 = 0
+x = _var4.fillna(_var5)
+scaler = StandardScaler()
+x_0 = scaler.fit_transform(x)
+_var10 = 0.2
+(_var6, _var7, _var8, _var9) = train_test_split(x_0, y, test_size=_var10)
+x_train = _var6
+x_test = _var7
+y_train = _var8
+y_test = _var9
+_var11 = x_train.shape
+_var12 = np.mean(y_test)
+print(_var11, _var12)
@@ -0,0 +1,22 @@
+# In[1]:
+
+
+import pandas as pd
+import numpy as np
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+df = pd.read_csv('train.csv')
+
+# In[2]:
+
+
+y = df.pop('label')
+x = df.drop('id', axis=1).fillna(0)
+scaler = StandardScaler()
+x = scaler.fit_transform(x)
+
+# In[3]:
+
+
+x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.2)
+print(x_train.shape, np.mean(y_test))
@@ -1,4 +1,9 @@
+import os
 import json
+import shutil
+
+import pytest
+import tornado
 
 
 async def test_get_example(jp_fetch):
@@ -10,4 +15,303 @@ async def test_get_example(jp_fetch):
     payload = json.loads(response.body)
     assert payload == {
         "data": "This is /data-leakage-detection/get_example endpoint!"
-    }
\ No newline at end of file
+    }
+
+
+async def test_unknown_job(jp_fetch):
+    with pytest.raises(tornado.httpclient.HTTPClientError) as e:
+        await jp_fetch("data-leakage-detection", "detect", "0123abcd")
+    assert e.value.code == 404
+    with pytest.raises(tornado.httpclient.HTTPClientError) as e:
+        await jp_fetch("data-leakage-detection", "detect", "0123abcd", method="DELETE")
+    assert e.value.code == 404
+
+
+async def test_detect_job(jp_fetch, monkeypatch):
+    import asyncio
+    from data_leakage_detection import handlers
+
+    def analyze(job, input_file_name, root_dir, cells=None):
+        job.enter_stage("datalog")
+        return {"name": input_file_name, "report": []}
+    monkeypatch.setattr(handlers, "analyze", analyze)
+
+    response = await jp_fetch("data-leakage-detection", "detect", method="POST", body=json.dumps({"name": "a.py"}))
+    assert response.code == 202
+    job_id = json.loads(response.body)["job"]
+    # the client polls until the job is over
+    for _ in range(100):
+        response = await jp_fetch("data-leakage-detection", "detect", job_id)
+        payload = json.loads(response.body)
+        if payload["status"] not in ("queued", "running"):
+            break
+        await asyncio.sleep(0.05)
+    assert payload["status"] == "done"
+    assert payload["result"] == {"name": "a.py", "report": []}
+    assert [stage["Stage"] for stage in payload["stages"]] == ["datalog"]
+
+
+async def test_metrics(jp_fetch):
+    response = await jp_fetch("data-leakage-detection", "metrics")
+    assert response.code == 200
+    payload = json.loads(response.body)
+    assert set(payload) == {"histograms", "counters"}
+
+    response = await jp_fetch("data-leakage-detection", "metrics", params={"format": "prometheus"})
+    assert response.code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+
+
+def test_notebook_cell_map():
+    from data_leakage_detection.notebook import notebook_to_script
+
+    nb = {"cells": [
+        {"cell_type": "markdown", "source": "# Title"},
+        {"cell_type": "code", "execution_count": 1, "source": "import pandas as pd\ndf = pd.read_csv('a.csv')"},
+        {"cell_type": "code", "execution_count": None, "source": "df.head()"},
+    ]}
+    script, cell_map = notebook_to_script(nb)
+    lines = script.split("\n")
+    assert lines[3:6] == ["# In[1]:", "", ""]
+    # cells are counted as in the notebook, markdown included
+    assert cell_map.locate(lines.index("df = pd.read_csv('a.csv')") + 1) == (1, 1)
+    assert cell_map.locate(lines.index("df.head()") + 1) == (2, 0)
+
+
+async def test_detect_invalid_cells(jp_fetch):
+    with pytest.raises(tornado.httpclient.HTTPClientError) as e:
+        await jp_fetch("data-leakage-detection", "detect", method="POST",
+                       body=json.dumps({"name": "a.ipynb", "cells": [{"cell_type": "code"}]}))
+    assert e.value.code == 400
+
+
+def test_job_coalescing():
+    import threading
+    from data_leakage_detection.jobs import JobManager
+
+    manager = JobManager(1, 10)
+    release = threading.Event()
+    def work(job, version):
+        job.enter_stage("ir")
+        release.wait()
+        job.enter_stage("datalog")
+        return version
+
+    first = manager.submit("a.ipynb", work, 1, key="v1")
+    assert manager.submit("a.ipynb", work, 1, key="v1") is first
+    # a new version cancels the running job at its next stage
+    second = manager.submit("a.ipynb", work, 2, key="v2")
+    release.set()
+    manager.executor.shutdown(wait=True)
+    assert first.status == "cancelled" and first.superseded_by == second.id
+    assert second.status == "done" and second.result == 2
+
+
+def test_scheduler_slots(tmp_path):
+    import threading
+    from data_leakage_detection.scheduler import Scheduler
+
+    scheduler = Scheduler(str(tmp_path), 1)
+    held, release = threading.Event(), threading.Event()
+    def hold():
+        with scheduler.slot("datalog"):
+            held.set()
+            release.wait()
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    positions = []
+    def give_up(position):
+        positions.append(position)
+        raise RuntimeError("cancelled")
+    with pytest.raises(RuntimeError):
+        with scheduler.slot("datalog", give_up):
+            pass
+    release.set()
+    holder.join()
+    assert positions == [0]
+    assert scheduler.waiting() == []
+
+
+def test_procs_deadline():
+    from data_leakage_detection import procs
+
+    completed = procs.run(["sh", "-c", "echo starting >&2; sleep 30"], timeout=0.5)
+    assert completed.timed_out and not completed.ok
+    assert "timed out" in completed.diagnostics() and "starting" in completed.diagnostics()
+
+
+def test_procs_cpu_budget():
+    from data_leakage_detection import procs
+
+    completed = procs.run(["sh", "-c", "while :; do :; done"], timeout=30, cpu_seconds=1)
+    assert completed.over_budget and not completed.timed_out
+    assert not procs.run(["sh", "-c", "exit 1"], cpu_seconds=1).over_budget
+
+
+def test_incremental_lowering(capsys):
+    import ast
+    from data_leakage_detection.global_collector import GlobalCollector
+    from data_leakage_detection.irgen import unparse
+    from data_leakage_detection.incremental import CellCache
+
+    cache = CellCache(1)
+    def lower(cells):
+        lines = []
+        for i, cell in enumerate(cells):
+            lines += ["# In[{}]:".format(i + 1), "", ""] + cell.split("\n") + [""]
+        code = "\n".join(lines)
+        tree = ast.parse(code)
+        ir, _ = unparse(cache.transform("a.ipynb", tree, lines, GlobalCollector().visit(tree)))
+        tree = ast.parse(code)
+        assert ir == unparse(CellCache(1).transform("a.ipynb", tree, lines, GlobalCollector().visit(tree)))[0]
+        return ir, capsys.readouterr().out.split("\n")[0]  # the line of the cache under test
+
+    cells = ["import pandas as pd\ndf = pd.read_csv('a.csv')",
+             "x = df.drop('y', axis=1)\ny = df.pop('y')",
+             "def scale(a):\n    return a / a.max()\nx = scale(x)",
+             "x_train, x_test = train_test_split(x)\nprint(x_train, y)"]
+    ir, out = lower(cells)
+    assert "Lowered 4 of 4" in out
+    # the same IR as lowering the whole notebook again, after each edit
+    assert "Lowered 1 of 4" in lower(cells[:3] + ["x_train, x_test = train_test_split(x, y)\nprint(x_test)"])[1]
+    lower(cells[:1] + ["x = df.fillna(0)\ny = df.pop('y')"] + cells[2:])
+    lower(cells[:1] + ["x = df\nz = x"] + cells[2:])
+    lower(cells)
+    # cells name their temporaries in namespaces of their own, inserting one leaves the IR of the others as it was
+    inserted, out = lower(cells[:1] + ["n = len(df.columns)"] + cells[1:])
+    assert "Lowered 1 of 5" in out
+    assert set(ir.split("\n")) <= set(inserted.split("\n"))
+    # as does a copy of a cell, which gets the next namespace of its code
+    _, out = lower(cells + cells[3:])
+    assert "Lowered 1 of 5" in out
+
+
+def test_lineno_map():
+    import ast
+    import copy
+    from data_leakage_detection.global_collector import GlobalCollector
+    from data_leakage_detection.irgen import CodeTransformer, unparse
+
+    code = """import pandas as pd
+df = pd.read_csv('a.csv')
+try:
+    x = df.drop('y', axis=1)
+except ValueError as e:
+    x = df.fillna(0)
+except KeyError:
+    x = df
+finally:
+    y = df.pop('y')
+big = len(x) > 10
+if big:
+    z = x.sample(10)
+elif x.empty:
+    z = df
+elif y.empty:
+    z = x.head(5)
+else:
+    z = x.mean(axis=1)
+print(f"é {z!r}")
+"""
+    def check(tree):
+        lowered = copy.deepcopy(tree)
+        ir, lineno_map = unparse(tree)
+        # the map and positions a reparse of the IR gives
+        reparsed = ast.parse(ir)
+        nodes = lambda t: [n for n in ast.walk(t) if isinstance(n, (ast.stmt, ast.excepthandler))]
+        expected = {}
+        for a, b, c in zip(nodes(lowered), nodes(reparsed), nodes(tree)):
+            assert type(a) is type(b)
+            if getattr(a, "lineno", None) is not None:
+                expected[str(b.lineno)] = str(a.lineno)
+            assert (c.lineno, c.col_offset, c.end_lineno, c.end_col_offset) == \
+                (b.lineno, b.col_offset, b.end_lineno, b.end_col_offset)
+        assert lineno_map == expected
+        # handlers, finally bodies and elifs have lines of their own
+        assert {"5", "7", "10", "14", "16"} <= set(lineno_map.values())
+        return ir
+
+    assert "elif" not in check(CodeTransformer(GlobalCollector().visit(ast.parse(code))).visit(ast.parse(code)))
+    # lowering nests elifs in else blocks, the unparser writes them back as elif
+    assert "elif" in check(ast.parse(code))
+
+
+
+# scripts with the IR and facts (as sorted "Relation<TAB>row" lines) they had before ScopeManager
+# frames, in-place lowering and interned facts, and the type map the facts were generated with
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "golden")
+
+
+@pytest.mark.parametrize("name", ["notebook", "control", "functions"])
+def test_golden_lowering(tmp_path, name):
+    import ast
+    from data_leakage_detection import factgen
+    from data_leakage_detection.global_collector import GlobalCollector
+    from data_leakage_detection.irgen import CodeTransformer, unparse
+
+    golden = os.path.join(GOLDEN_DIR, name)
+    with open(golden + ".py") as f:
+        tree = ast.parse(f.read())
+    tree = CodeTransformer(GlobalCollector().visit(tree)).visit(tree)
+    ir, _ = unparse(tree)
+    with open(golden + ".ir.py") as f:
+        assert ir == f.read()
+
+    def facts(tree, fact_manager, fact_path):
+        factgen.FactGenerator(golden + ".json", fact_manager).visit(tree)
+        fact_manager.write_facts(fact_path)
+        fact_manager.close()
+        rows = set()
+        for file_name in os.listdir(fact_path):
+            with open(os.path.join(fact_path, file_name)) as f:
+                rows.update(file_name[:-len(".facts")] + "\t" + row for row in f.read().splitlines())
+        return "".join(row + "\n" for row in sorted(rows))
+
+    with open(golden + ".facts") as f:
+        expected = f.read()
+    # the lowered tree as unparse left it, and the IR parsed again as when it comes from the artifact store
+    assert facts(tree, factgen.FactManager(), str(tmp_path)) == expected
+    (tmp_path / "streaming").mkdir()
+    streaming = factgen.StreamingFactManager(str(tmp_path / "streaming"), 256)
+    assert facts(ast.parse(ir), streaming, str(tmp_path / "streaming")) == expected
+
+# like the webpack CLI bundle: main() runs as soon as it is loaded, and exits with pyright's codes
+FAKE_PYRIGHT = """
+const fs = require('fs');
+async function main() {
+  const p = process.argv[2];
+  if (p.endsWith('.ir.py') && !p.includes('nomap')) {
+    fs.writeFileSync(p.replace(/\\.ir\\.py$/, '.json'), '{}');
+  }
+  process.exit(p.includes('crash') ? 2 : 1);
+}
+exports.main = main;
+main();
+"""
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+def test_inference_server(tmp_path):
+    from data_leakage_detection import inference
+
+    (tmp_path / "dist").mkdir()
+    (tmp_path / "dist" / "pyright.js").write_text(FAKE_PYRIGHT)
+    server = inference.InferenceServer(str(tmp_path / "index.js"), inference.SERVER_PATH)
+    def infer(name):
+        (tmp_path / (name + ".ir.py")).write_text("x = 1\n")
+        return server.infer(str(tmp_path / (name + ".ir.py")), str(tmp_path / (name + ".json")), 30)
+    try:
+        assert infer("a").ok and (tmp_path / "a.json").exists()
+        pid = server.proc.pid
+        # crashes and missing type maps send the caller to a one-shot pyright
+        assert infer("crash") is None
+        assert infer("nomap") is None
+        assert infer("b").ok and server.proc.pid == pid
+    finally:
+        server.stop()
+
+    # a bundle without main() is not restarted for every request
+    (tmp_path / "dist" / "pyright.js").write_text("exports.version = '1';")
+    assert infer("c") is None and server.unsupported
+    assert infer("d") is None and server.proc is None
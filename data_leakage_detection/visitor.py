@@ -0,0 +1,22 @@
+'''
+Visitor dispatch through a per-class table: visit_<NodeClass> is looked up once for every pair of
+visitor class and node class, instead of building the method name and calling getattr at every node
+'''
+class CachedDispatch(object):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.dispatch = {}  # node class -> function, filled on first use
+
+    def visit(self, node):
+        """Visit a node."""
+        try:
+            method = self.dispatch[node.__class__]
+        except KeyError:
+            method = self.resolve(node.__class__)
+        return method(self, node)
+
+    @classmethod
+    def resolve(cls, node_class):
+        method = getattr(cls, 'visit_' + node_class.__name__, cls.generic_visit)
+        cls.dispatch[node_class] = method
+        return method
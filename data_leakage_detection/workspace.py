@@ -0,0 +1,81 @@
+import os
+import queue
+import atexit
+import shutil
+import tempfile
+import threading
+from .config import configs
+
+'''
+Per-job scratch directories: every analysis keeps its intermediate files (IR, types, facts, souffle
+outputs) in a directory of its own, so concurrent analyses of the same file cannot trample each other,
+under a memory-backed scratch root when there is one; they are removed in the background
+'''
+SHM = "/dev/shm"
+SHM_MIN_FREE_BYTES = 256 << 20  # containers often get a small /dev/shm
+
+_trash = queue.Queue()
+_cleaner = None
+_cleaner_lock = threading.Lock()
+
+def scratch_root():
+    if configs.scratch_dir:
+        return configs.scratch_dir
+    try:
+        st = os.statvfs(SHM)
+        if os.access(SHM, os.W_OK | os.X_OK) and st.f_bavail * st.f_frsize >= SHM_MIN_FREE_BYTES:
+            return SHM
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+def clean():
+    while True:
+        shutil.rmtree(_trash.get(), ignore_errors=True)
+        _trash.task_done()
+
+def remove_later(path):
+    global _cleaner
+    with _cleaner_lock:
+        if _cleaner is None:
+            _cleaner = threading.Thread(target=clean, name="workspace-cleaner", daemon=True)
+            _cleaner.start()
+    _trash.put(path)
+
+@atexit.register
+def drain():
+    # the cleaner is a daemon thread, do not leave directories behind in memory
+    while True:
+        try:
+            path = _trash.get_nowait()
+        except queue.Empty:
+            return
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class Workspace(object):
+    def __init__(self, prefix="job-") -> None:
+        base = scratch_root()
+        os.makedirs(base, exist_ok=True)
+        root = os.path.join(base, "data_leakage_detection")
+        try:
+            os.mkdir(root)
+        except FileExistsError:
+            pass
+        try:
+            os.chmod(root, 0o1777)  # shared by the servers of every user, as /tmp
+        except OSError:  # created by another user, who did the same
+            pass
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def discard(self):
+        remove_later(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.discard()
@@ -18,6 +18,7 @@ import { DocumentRegistry } from '@jupyterlab/docregistry';
 
 import { NotebookPanel, INotebookModel, INotebookTracker } from '@jupyterlab/notebook';
 import { IStatusBar } from '@jupyterlab/statusbar';
+import { ServerConnection } from '@jupyterlab/services';
 
 import { CodeMirrorEditor } from '@jupyterlab/codemirror';
 import { Cell } from '@jupyterlab/cells';
@@ -233,9 +234,8 @@ const highlight = (notebookTracker: INotebookTracker, highlightMap: any) => {
 let statusText: string = "Leakage analysis finished";
 let statusBarItem: any = null;
 
-const detect = async (filename: string, shell: JupyterFrontEnd.IShell, notebookTracker: INotebookTracker, statusBar: any) => {
-  // POST request
-  statusText = "Analyzing data leakage...";
+const setStatus = (statusBar: any, text: string) => {
+  statusText = text;
   if (statusBarItem) {
     statusBarItem.dispose();
   }
@@ -245,43 +245,103 @@ const detect = async (filename: string, shell: JupyterFrontEnd.IShell, notebookT
     align: 'middle',
     item: statusWidget,
   })
+}
+
+const POLL_INTERVAL = 1000;  // ms between two job status requests
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
+// jobs of this page still running, cancelled with their processes when the page goes away
+const runningJobs: Set<string> = new Set();
+
+const cancelRunningJobs = () => {
+  for (const id of runningJobs) {
+    requestAPI<any>(`detect/${id}`, { method: 'DELETE', keepalive: true }).catch(() => undefined);
+  }
+  runningJobs.clear();
+}
+
+// poll GET /detect/<job> until the background analysis is over
+const waitForJob = async (job: any, statusBar: any) => {
+  let stage = job.stage;
+  while (job.status === 'queued' || job.status === 'running') {
+    await sleep(POLL_INTERVAL);
+    job = await requestAPI<any>(`detect/${job.job}`, {
+      method: 'GET',
+    });
+    // a heavy stage waiting for a slot shared with the other users of the machine
+    const current = job.queue_position === null ? job.stage : `${job.stage}, ${job.queue_position} ahead in queue`;
+    if (current && current !== stage) {
+      stage = current;
+      setStatus(statusBar, `Analyzing data leakage (${stage})...`);
+    }
+  }
+  return job;
+}
+
+// the cells as they are on screen, saved or not; only code is analyzed, other cells keep their index
+const liveCells = (model: INotebookModel) => {
+  const cells: { cell_type: string, source: string }[] = [];
+  for (let i = 0; i < model.cells.length; i++) {
+    const cell = model.cells.get(i);
+    cells.push({ cell_type: cell.type, source: cell.type === 'code' ? cell.value.text : '' });
+  }
+  return cells;
+}
+
+const detect = async (filename: string, shell: JupyterFrontEnd.IShell, notebookTracker: INotebookTracker, statusBar: any) => {
+  // POST request
+  setStatus(statusBar, "Analyzing data leakage...");
 
-  const dataToSend = { name: filename };
+  const dataToSend: any = { name: filename };
+  const panel = notebookTracker.find(p => p.context.path === filename);
+  if (panel && panel.model) {
+    dataToSend.cells = liveCells(panel.model);
+  }
   muteAll();
   try {
-    const reply = await requestAPI<any>('detect', {
+    let job = await requestAPI<any>('detect', {
       body: JSON.stringify(dataToSend),
       method: 'POST',
     });
-    console.log(reply);
-    if (reply.ok) {
+    runningJobs.add(job.job);
+    try {
+      job = await waitForJob(job, statusBar);
+    } finally {
+      runningJobs.delete(job.job);
+    }
+    const reply = job.result;
+    console.log(job);
+    if (job.status === 'cancelled') {
+      // a newer version of the notebook was sent, its request reports the result
+      return;
+    }
+    if (job.status === 'done' && reply.ok) {
       // TODO: content in iframe not interactive
       // create highlightMap
 
       highlight(notebookTracker, reply.report);
-      statusText = "Leakage analysis finished";
-      statusBarItem.dispose();
-      const statusWidget = new Widget();
-      statusWidget.node.textContent = statusText;
-      statusBarItem = statusBar.registerStatusItem('detection-status', {
-        align: 'middle',
-        item: statusWidget,
-      })
+      if (reply.degraded && reply.degraded.length > 0) {
+        // some stages went over their budget and were rerun with a cheaper analysis
+        const levels = reply.degraded.map((stage: string) => `${stage} ${reply.precision[stage]}`).join(', ');
+        setStatus(statusBar, `Leakage analysis finished at reduced precision (${levels})`);
+      } else {
+        setStatus(statusBar, "Leakage analysis finished");
+      }
+    } else {
+      setStatus(statusBar, "Error during analysis!");
     }
-    // TODO: if not ok
   } catch (reason) {
+    if (reason instanceof ServerConnection.ResponseError && reason.response.status === 503) {
+      const retryAfter = reason.response.headers.get('Retry-After');
+      setStatus(statusBar, `Leakage analysis busy, try again in ${retryAfter} seconds`);
+      return;
+    }
     console.error(
       `Error on POST /data-leakage-detection/detect ${dataToSend}.\n${reason}`
     );
     // TODO: if error
-    statusText = "Error during analysis!";
-    statusBarItem.dispose();
-    const statusWidget = new Widget();
-    statusWidget.node.textContent = statusText;
-    statusBarItem = statusBar.registerStatusItem('detection-status', {
-      align: 'middle',
-      item: statusWidget,
-    })
+    setStatus(statusBar, "Error during analysis!");
   }
 }
 
@@ -396,6 +456,7 @@ const plugin: JupyterFrontEndPlugin<void> = {
 
     app.docRegistry.addWidgetExtension('Notebook', new AnalyzeMenuButton(shell, notebookTracker, statusBar));
     app.docRegistry.addWidgetExtension('Notebook', new MuteMenuButton());
+    window.addEventListener('beforeunload', cancelRunningJobs);
   },
 };
 